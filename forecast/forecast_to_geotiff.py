@@ -2,116 +2,116 @@
 This script converts counts.csv files to geotiffs.
 """
 
-import pandas as pd, argparse, os
-import geopandas as gpd
+import pandas as pd, numpy as np, argparse, os, sys
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
-from geocube.api.core import make_geocube
-from functools import partial
-from geocube.rasterize import rasterize_image
-import rasterio
 from pathlib import Path
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'other'))
+from basin_raster import basinLabelGrid, writeLabelledGeotiffs
 
 
-###############################################
-### SETUP 
-###############################################
+# the count columns in the order of their category numbers 1 to 5
+COUNT_COLUMNS = ['notLow', 'belNorm', 'norm', 'abNorm', 'notHigh']
 
-parser = argparse.ArgumentParser(
-                    prog='Hydro SOS csv_to_json PYTHON',
-                    description='Convert gridded forecast data (single and accumulated) to a single and accumulated monthly geotiff files.',
-                    epilog='Gemma N, Ezra K, UKCEH, 01082024')
-
-
-parser.add_argument('input_dir', help='input directory, should be set as the output directory of ForecastCalc.py.')   
-parser.add_argument('output_dir', help='directory files will be saved to as {date}.json.')    
-parser.add_argument('shapefile', help='path to the hydrosheds basin shapefile.')    
-parser.add_argument('forecast_start_date', help='Date YYYY-MM of the first forecast.')
-parser.add_argument('--forecast_length', help='length of the forecast (in months, default 6)')
-
-
-args = parser.parse_args()
-input_directory = args.input_dir
-output_directory = args.output_dir
-
-Path(output_directory).mkdir(parents=True, exist_ok=True)
-
-shapefile = args.shapefile
-forecastDate = datetime.strptime(args.forecast_start_date + '-01', "%Y-%m-%d")
-
-if args.forecast_length:
-    forecastLength=int(args.forecast_length)
-else: 
-    print("No forecast length set, defaulting to 6 months.")
-    forecastLength=6
-
-
- # convert hydrobasins shapefile to geodataframe
-gdf = gpd.read_file(args.shapefile, include_fields=['HYBAS_ID'])
-gdf['HYBAS_ID'] = gdf['HYBAS_ID'].astype('int').fillna(0)
-
-columns=[]
-for x in range (0, forecastLength+1):
-    date = (forecastDate + relativedelta(months=+x)).strftime("%Y-%m")
-    columns.append(date)
-
-#empty dataframe to append to
-smhi_counts_df = pd.DataFrame(columns=columns) 
+#read the counts files into one dataframe, file is the position in paths of each row's file. Also returns whether each file
+#has any rows and the COUNT_COLUMNS positions in the order of each file's columns
+def readCountsFiles(paths):
+    frames = [pd.read_csv(path, index_col=False) for path in paths]
+    df = pd.concat(frames or [pd.DataFrame(columns=['date'] + COUNT_COLUMNS)], ignore_index=True)
+    df['file'] = np.repeat(np.arange(len(frames)), [len(f) for f in frames])
+    hasRows = np.array([len(f) > 0 for f in frames], dtype=bool)
+    columnOrder = np.array([np.argsort([list(f.columns).index(c) for c in COUNT_COLUMNS]) for f in frames], dtype=int).reshape(-1, len(COUNT_COLUMNS))
+    return df, hasRows, columnOrder
 
 
 ################################################
 ### MAIN
 ################################################
 
-#ONE GEOTIFF FOR EACH MONTH WITH A NUMBER FROM 1 TO 5 FOR EACH HYDRABAS ID
-#THIS SCRIPT OUTPUTS 6 GEOTIFFS EACH NAMED WITH MONTH
-#GEOTIFFS ARE GLOBAL
-#ADD A PARAMTTER FOR NUMBER OF MONTHS OF FORECAST (DEFAULT 6)
-#THIS IS GRIDDED
-
-
-#loop through the pre-generated counts files 
-for file in os.listdir(input_directory + '/counts/'):
-    if file.endswith('.csv'):
-        #open the file
-        with open(input_directory+'/counts/'+file, mode="r") as fr:
-                df = pd.read_csv(fr, index_col=False)
-                # Find the column with the maximum value in each row
-                max_column = df.idxmax(axis=1, numeric_only=True)
-                df['HYBAS_ID'] = file.split('_')[0]
-                # Map column names to their corresponding index numbers
-                column_mapping = {'notLow': 1, 'belNorm': 2, 'norm': 3, 'abNorm': 4, 'notHigh': 5}
-                # Create the new column with the index of the column with the greatest number
-                df['value'] = max_column.map(column_mapping).fillna(0)
-                # pivot the df to add to the smhi_counts_df as extra column per date
-                df2 = df.pivot_table(index='HYBAS_ID', columns='date', values='value')
-                smhi_counts_df = pd.concat([smhi_counts_df, df2])
-
-smhi_counts_df=smhi_counts_df.reset_index()
-smhi_counts_df['HYBAS_ID'] = smhi_counts_df['index'].fillna(0).astype('int')
-#output each forecat month separately 
-for x in range (0, forecastLength+1):
-    date = (forecastDate + relativedelta(months=+x)).strftime("%Y-%m")
-    smhi_counts_df[date] = smhi_counts_df[date].fillna(0).astype('int')
-    print(smhi_counts_df)
-    output_df = smhi_counts_df.loc[:,['HYBAS_ID',date]]
-    print(output_df)
-
-    # Specify output GeoTIFF file path
-    output_geotiff = f"{output_directory}{date}_counts.tif"
-    #make all the counts values integers and fill all the missing values with -999 
-
-    #merge the hydrobasins with the counts_df
-    gdf_join = gdf.merge(output_df, left_on='HYBAS_ID', right_on='HYBAS_ID')
-
-    #make geocube converts vector data to raster...
-    out_grid = make_geocube(
-        vector_data=gdf_join,
-        measurements=[date],
-        fill=0,
-        resolution=(-0.05, 0.05), #if the resolution is greater than 0.05 it falls over as too big a dataset.
-        rasterize_function=partial(rasterize_image, all_touched=True, dtype='int8')
-    )
-
-    #export the grid to a geotiff for the portal via mapserver (hydrosos_hydrobasins.map)
-    out_grid.rio.to_raster(output_geotiff, driver="COG", tiled=True, windowed=True,  dtype=rasterio.uint8)
\ No newline at end of file
+def main():
+    parser = argparse.ArgumentParser(
+                        prog='Hydro SOS csv_to_json PYTHON',
+                        description='Convert gridded forecast data (single and accumulated) to a single and accumulated monthly geotiff files.',
+                        epilog='Gemma N, Ezra K, UKCEH, 01082024')
+
+
+    parser.add_argument('input_dir', help='input directory, should be set as the output directory of ForecastCalc.py.')   
+    parser.add_argument('output_dir', help='directory files will be saved to as {date}.json.')    
+    parser.add_argument('shapefile', help='path to the hydrosheds basin shapefile.')    
+    parser.add_argument('forecast_start_date', help='Date YYYY-MM of the first forecast.')
+    parser.add_argument('--forecast_length', help='length of the forecast (in months, default 6)')
+    parser.add_argument('--cacheDirectory', help='if set, the rasterised basins are cached in this directory and later runs only read the shapefile if it has changed')
+    parser.add_argument('--resolution', help='resolution of the geotiffs in degrees (default 0.05), use --tileSize for finer resolutions')
+    parser.add_argument('--tileSize', help='if set, the geotiffs are rasterised and written this many rows at a time so memory is bounded for fine resolutions')
+    parser.add_argument('--workers', help='number of geotiffs to write in parallel (default 1)')
+
+
+    args = parser.parse_args()
+    input_directory = args.input_dir
+    output_directory = args.output_dir
+
+    Path(output_directory).mkdir(parents=True, exist_ok=True)
+
+    shapefile = args.shapefile
+    forecastDate = datetime.strptime(args.forecast_start_date + '-01', "%Y-%m-%d")
+
+    if args.forecast_length:
+        forecastLength=int(args.forecast_length)
+    else: 
+        print("No forecast length set, defaulting to 6 months.")
+        forecastLength=6
+
+    #if the resolution is finer than 0.05 the global grid is too big a dataset to make in memory, so use --tileSize
+    resolution = (-float(args.resolution), float(args.resolution)) if args.resolution else (-0.05, 0.05)
+    tileSize = int(args.tileSize) if args.tileSize else None
+    workers = int(args.workers) if args.workers else 1
+
+
+    columns=[]
+    for x in range (0, forecastLength+1):
+        date = (forecastDate + relativedelta(months=+x)).strftime("%Y-%m")
+        columns.append(date)
+
+    #ONE GEOTIFF FOR EACH MONTH WITH A NUMBER FROM 1 TO 5 FOR EACH HYDRABAS ID
+    #THIS SCRIPT OUTPUTS 6 GEOTIFFS EACH NAMED WITH MONTH
+    #GEOTIFFS ARE GLOBAL
+    #ADD A PARAMTTER FOR NUMBER OF MONTHS OF FORECAST (DEFAULT 6)
+    #THIS IS GRIDDED
+
+
+    #load the pre-generated counts files into one (basin x forecast month x count column) array
+    files = [file for file in os.listdir(input_directory + '/counts/') if file.endswith('.csv')]
+    df, hasRows, columnOrder = readCountsFiles([input_directory+'/counts/'+file for file in files])
+    months = pd.Index(columns)
+    month = months.get_indexer(df['date'].astype(str))
+    counts = np.full((len(files), len(months), len(COUNT_COLUMNS)), np.nan)
+    counts[df['file'].to_numpy()[month >= 0], month[month >= 0]] = df.loc[month >= 0, COUNT_COLUMNS].to_numpy(dtype=float)
+
+    # the category of each basin and month is the number of the column with the greatest count (the first in the file if tied),
+    # 0 if there are no counts for that month
+    ordered = np.take_along_axis(counts, columnOrder[:, None, :], axis=2)
+    first = np.where(np.isnan(ordered), -np.inf, ordered).argmax(axis=2)
+    categories = np.take_along_axis(columnOrder, first, axis=1) + 1
+    categories[np.isnan(counts).all(axis=2)] = 0
+    categories = categories[hasRows]
+    basins = pd.DataFrame({'HYBAS_ID': pd.Series([file.split('_')[0] for file in files], dtype=object)[hasRows].astype('int')})
+    print(f"Read the counts of {len(basins)} basins.")
+
+    #merge the hydrobasins with the counts, the same basins are in every month so they're only rasterised once
+    #rows is the counts row of each joined basin
+    labelGrid, rows = basinLabelGrid(shapefile, basins, resolution, cacheDirectory=args.cacheDirectory, tileSize=tileSize)
+
+    #output each forecat month separately 
+    tasks = []
+    for x, date in enumerate(columns):
+        # Specify output GeoTIFF file path
+        output_geotiff = f"{output_directory}{date}_counts.tif"
+        #look up the count category of each basin in the label grid and export it for the portal
+        tasks.append((categories[rows, x], date, output_geotiff))
+
+    #the months are independent so they can be written in parallel
+    print(f"Writing {len(tasks)} geotiffs.")
+    writeLabelledGeotiffs(labelGrid, tasks, tileSize, workers)
+
+if __name__ == "__main__":
+    main()
@@ -17,317 +17,545 @@ V1 Gemma Nash/Ezra Kitson UKCEH 24075024
 # Libraries
 ##############################################
 
-import pandas as pd, os
+import pandas as pd, numpy as np, io, os, sys, warnings
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import partial
 from pathlib import Path
-from scipy.stats.mstats import mquantiles
 import argparse
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'other'))
+from ingest_cache import readCached
+from reformatESP import espCatchmentFiles, splitESP
 
 
-##############################################
-# Input 
-##############################################
-print("**************************************")
-print("Input:")
-print("Parsing arguments.")
-
-parser = argparse.ArgumentParser(
-                    prog='ForecastCalc PYTHON',
-                    description='Calculates forecast based on daily timeseries for the HydroSOS portal',
-                    epilog='Gemma N, Ezra K, UKCEH, 25057024')
-
-parser.add_argument('obs_dir', help='directory containing obsserved simulated (obssim) data as timeseries, should ONLY contain .csv daily timeseries, filenames should be formatted X_CATCHMENTID.csv see GitHub for examples.')        
-parser.add_argument('forecast_dir', help='directory containing forecast data for the next X months, should only contain .csv monthly forecasts, filenames should be formatted X_ENS_CATCHMENTID.csv, see GitHub for examples.')     
-parser.add_argument('output_dir', help=
-                    'directory files will be saved to. Four sub directories will be created in this directory forecastBand, forecasts, counts and percentiles') 
-parser.add_argument('--obsDirStartingMonth', help='Starting month in the obsDir dataset (default january)') 
-parser.add_argument('--varName', help='Name of the variable in your data files, default is Discharge') 
-
-
-args = parser.parse_args()
-forecast_directory = args.forecast_dir
-status_directory = args.obs_dir
-output_directory = args.output_dir
-
-print('Making output directories.')
-
-#make output subdirectories
-Path(output_directory+'/accumulated/counts').mkdir(parents=True, exist_ok=True)
-Path(output_directory+'/accumulated/forecastBands').mkdir(parents=True, exist_ok=True)
-Path(output_directory+'/accumulated/forecasts').mkdir(parents=True, exist_ok=True)
-Path(output_directory+'/accumulated/percentiles').mkdir(parents=True, exist_ok=True)
-Path(output_directory+'/accumulated/status').mkdir(parents=True, exist_ok=True)
-Path(output_directory+'/accumulated/statusBands').mkdir(parents=True, exist_ok=True)
-
-Path(output_directory+'/single/counts').mkdir(parents=True, exist_ok=True)
-Path(output_directory+'/single/forecastBands').mkdir(parents=True, exist_ok=True)
-Path(output_directory+'/single/forecasts').mkdir(parents=True, exist_ok=True)
-Path(output_directory+'/single/percentiles').mkdir(parents=True, exist_ok=True)
-
-Path(output_directory+'/status/status').mkdir(parents=True, exist_ok=True)
-Path(output_directory+'/status/statusBands').mkdir(parents=True, exist_ok=True)
-
-#calculate the forecast month 
-forecast_month = int(pd.read_csv(f"{forecast_directory}/{os.listdir(forecast_directory)[0]}").loc[0,'Date'].split('-')[1])
-print(f"First forecast month set as {forecast_month}. \n")
-
-#calculate which row to slice the obs sim data with
-if args.obsDirStartingMonth:
-    print(f"Obs Dir Starting month set as {int(args.obsDirStartingMonth)}.")
-    obsSimSlice = forecast_month - int(args.obsDirStartingMonth)
-    if obsSimSlice < 0: 
-        obsSimSlice = 12 + obsSimSlice
-    print(f"Obs sim slicing starts from row {obsSimSlice}")
-else:
-    print(f"Obs Dir Starting month set as january.")
-    obsSimSlice = forecast_month -1
-    print(f"Obs sim slicing starts from row {obsSimSlice}")
-
-#check the variable name to use
-if args.varName:
-    varName=args.varName
-else:
-    varName='Discharge'
-
 ##############################################
 # Functions 
 ##############################################
 
+#the forecasts of every catchment as a (catchment x lead month x member) array, with the catchment ids, lead month dates and
+#member (ENS) names as coordinates. hasMember marks which members each catchment has, the values of missing members are na
+EnsembleCube = namedtuple('EnsembleCube', ['catchments', 'dates', 'members', 'values', 'hasMember'])
+#the command line settings the reading and writing functions need, made once in main and passed to them (and the workers)
+Settings = namedtuple('Settings', ['forecast_directory', 'status_directory', 'output_directory', 'inputFormat', 'outputFormat', 'varName',
+                                   'obsDirStartingMonth', 'forecastDate', 'cacheDirectory'])
+PERCENTILE_COLUMNS = ['min','mean','max','10%','25%','75%','90%']
+BAND_PROB = [.05,.10,.25,.75,.90,.95]
+BAND_COLUMNS = ['min','mean','max','5%','10%','25%','75%','90%','95%']
+COUNT_COLUMNS = ['notLow','belNorm','norm','abNorm','notHigh']
+
+#make the forecast output subdirectories, prefix is the forecast start date subdirectory in hindcast mode
+def makeOutputDirectories(settings, prefix=''):
+    for subdirectory in ['accumulated/counts', 'accumulated/forecastBands', 'accumulated/forecasts', 'accumulated/percentiles',
+                         'accumulated/status', 'accumulated/statusBands',
+                         'single/counts', 'single/forecastBands', 'single/forecasts', 'single/percentiles']:
+        Path(f"{settings.output_directory}/{prefix}{subdirectory}").mkdir(parents=True, exist_ok=True)
+
+#the month of the first forecast in a forecast directory
+def getForecastMonth(settings, directory):
+    if settings.inputFormat == 'esp':
+        espFiles = espCatchmentFiles(directory, settings.forecastDate)
+        return splitESP(pd.read_csv(f"{directory}/{next(iter(espFiles.values()))}"))[1]['Date'].min().month
+    if settings.inputFormat == 'parquet':
+        return pd.read_parquet(f"{directory}/{sorted(os.listdir(directory))[0]}", columns=['Date'])['Date'].min().month
+    return int(pd.read_csv(f"{directory}/{os.listdir(directory)[0]}").loc[0,'Date'].split('-')[1])
+
+#calculate which row to slice the obs sim data with, for forecasts starting in forecast_month
+def getObsSimSlice(settings, forecast_month):
+    if settings.obsDirStartingMonth:
+        obsSimSlice = forecast_month - int(settings.obsDirStartingMonth)
+        if obsSimSlice < 0: 
+            obsSimSlice = 12 + obsSimSlice
+        return obsSimSlice
+    return forecast_month -1
+
+#write an output table as {cid}_{suffix}.csv, or as the catchment's partition of a parquet dataset
+def writeOutput(settings, df, subdirectory, cid, suffix, columns=None, float_format=None):
+    if settings.outputFormat == 'parquet':
+        path = f"{settings.output_directory}/{subdirectory}/stationID={cid}/part-0.parquet"
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        if columns is not None:
+            df = df[columns]
+        df.to_parquet(path, index=False)
+    else:
+        df.to_csv(f"{settings.output_directory}/{subdirectory}/{cid}_{suffix}.csv", header=True, index=False, columns=columns, float_format=float_format)
+
+#read an obssim or forecast csv with its Date column parsed
+def parseInputCsv(f, date_format):
+    df = pd.read_csv(f, parse_dates=['Date'], date_format=date_format)
+    df['Date'] = pd.to_datetime(df['Date'])
+    return df
+
+#read an input csv, through the ingest cache if --cacheDirectory is set so unchanged files aren't parsed again
+def readInputCsv(settings, path, date_format):
+    if settings.cacheDirectory:
+        return readCached(path, partial(parseInputCsv, date_format=date_format), settings.cacheDirectory, key=f"forecastcalc {date_format}")
+    return parseInputCsv(path, date_format)
+
+#read a catchment's ensemble members as the lead month dates, member names and a (lead month x member) array
+def readCatchmentForecasts(settings, cid, catchmentFiles):
+    if settings.inputFormat == 'parquet':
+        members = pd.read_parquet(f"{settings.forecast_directory}/{catchmentFiles['forecasts'][0][1]}")
+        members['ENS'] = members['ENS'].astype(str)
+        members.loc[~members['ENS'].str.contains('ENS'), 'ENS'] = 'ENS' + members['ENS']
+        pivoted = members.pivot(index='Date', columns='ENS', values=settings.varName).sort_index()
+        return pd.DatetimeIndex(pivoted.index), list(pivoted.columns), pivoted.to_numpy(dtype=float)
+    dates = None
+    names = []
+    values = []
+    for ENS, filename in catchmentFiles['forecasts']:
+        df = readInputCsv(settings, settings.forecast_directory+'/'+filename, "%Y-%m")
+        dates = pd.DatetimeIndex(df['Date'])
+        names.append(ENS)
+        values.append(df[settings.varName].to_numpy(dtype=float))
+    #members are lined up by row, as the dates of every member should be the same
+    leadMonths = max(len(v) for v in values)
+    return dates, names, np.column_stack([np.pad(v, (0, leadMonths - len(v)), constant_values=np.nan) for v in values])
+
+#stack the forecasts of every catchment (as read by readCatchmentForecasts) into one ensemble cube
+def buildEnsembleCube(catchments, forecasts):
+    #members are numbered in the order they are first seen, catchments without a member have na for it
+    members = list(dict.fromkeys(name for _, names, _ in forecasts for name in names))
+    memberIdx = {name: i for i, name in enumerate(members)}
+    leadMonths = max(values.shape[0] for _, _, values in forecasts)
+    dates = next(dates for dates, _, values in forecasts if values.shape[0] == leadMonths)
+    values = np.full((len(catchments), leadMonths, len(members)), np.nan)
+    hasMember = np.zeros((len(catchments), len(members)), dtype=bool)
+    for i, (_, names, catchmentValues) in enumerate(forecasts):
+        columns = [memberIdx[name] for name in names]
+        values[i, :catchmentValues.shape[0], columns] = catchmentValues.T
+        hasMember[i, columns] = True
+    return EnsembleCube(list(catchments), dates, members, values, hasMember)
+
+#a catchment's (lead month x column) slice of a cube or cube result as a table with a date column, to write it out
+def catchmentTable(dates, values, columns):
+    table = pd.DataFrame(values, columns=columns)
+    table.insert(0, 'date', dates.strftime('%Y-%m'))
+    return table
+
+#a catchment's members as a date + ENS columns table
+def catchmentForecasts(cube, i):
+    return catchmentTable(cube.dates, cube.values[i][:, cube.hasMember[i]], [m for m, has in zip(cube.members, cube.hasMember[i]) if has])
+
+#map each catchment id to its (ENS, filename) forecast members and its obssim files, from one listing of each directory
+#prefix is the subdirectory of forecast_dir the forecasts are in, in hindcast mode, forecast filenames include it
+def buildCatchmentIndex(settings, prefix=''):
+    catchmentIndex = {}
+    if settings.inputFormat == 'esp':
+        #each catchment's obssim data and members are in one combined file
+        return {cid: {'forecasts': [], 'status': [f]} for cid, f in espCatchmentFiles(settings.forecast_directory, settings.forecastDate).items()}
+    statusFiles = sorted(os.listdir(settings.status_directory))
+    if settings.inputFormat == 'parquet':
+        #a catchment's members are all in its partition of the dataset
+        for filename in sorted(os.listdir(f"{settings.forecast_directory}/{prefix}")):
+            if filename.startswith('stationID='):
+                catchmentIndex[filename.split('=')[1]] = {'forecasts': [(None, prefix + filename)], 'status': [f for f in [filename] if f in statusFiles]}
+        return catchmentIndex
+    for filename in sorted(os.listdir(f"{settings.forecast_directory}/{prefix}")):
+        if filename.endswith('.csv'): 
+            #forecast filenames are X_ENS_CATCHMENTID.csv, include the letters ENS if they are missing
+            filenameParts = filename.split('_')
+            ENS = filenameParts[1] if 'ENS' in filenameParts[1] else 'ENS'+filenameParts[1]
+            cid = filenameParts[2].split('.csv')[0]
+            catchmentIndex.setdefault(cid, {'forecasts': [], 'status': []})['forecasts'].append((ENS, prefix + filename))
+    #in status files, the first underscore split contains the catchment id
+    for f in statusFiles:
+        filenameParts = f.split('_')
+        if len(filenameParts) > 1 and filenameParts[1].split('.csv')[0] in catchmentIndex:
+            catchmentIndex[filenameParts[1].split('.csv')[0]]['status'].append(f)
+    return catchmentIndex
+
+#calculate the obssim climatology once per catchment: the monthly means, the months they cover, the means as a (month x year) array
+#with a row for every calendar month, and the means as one array in date order
+def getClimatology(df, varName):
+    monthlyMeans = df.groupby(['year','month'], as_index=False)[varName].mean()
+    pivotedMeans = monthlyMeans.pivot(index='month', columns='year', values=varName)
+    months = pivotedMeans.index.to_numpy()
+    return monthlyMeans, months, pivotedMeans.reindex(range(1, 13)).to_numpy(dtype=float), monthlyMeans[varName].to_numpy()
+
+#realign a catchment's monthly means to start at the forecast month, as a (year x relative month) array with incomplete years at the end left out
+def reshapeClimatology(values, obsSimSlice):
+    years = max(0, (len(values) - obsSimSlice) // 12)
+    return values[obsSimSlice:obsSimSlice + 12 * years].reshape(years, 12)
+
+#cunnane empirical quantiles (alphap = betap = .4) along the last axis of an array, for any number of rows at once
+#n is the number of values in each row, by default its non na values, which gives the same values as scipy's mquantiles with
+#the na values masked. Passing the row length instead counts na values as the largest values, as mquantiles does with unmasked na
+def cunnaneQuantiles(values, prob, n=None, alphap=.4, betap=.4):
+    #sorting puts the na values at the end of each row
+    x = np.sort(values, axis=-1)
+    if x.shape[-1] < 2:
+        x = np.concatenate([x, np.full(x.shape[:-1] + (2 - x.shape[-1],), np.nan)], axis=-1)
+    if n is None:
+        n = (~np.isnan(x)).sum(axis=-1, keepdims=True)
+    n = np.broadcast_to(n, x.shape[:-1] + (1,))
+    p = np.asarray(prob, dtype=float)
+    m = alphap + p*(1.-alphap-betap)
+    aleph = (n*p + m)
+    k = np.floor(aleph.clip(1, np.maximum(n-1, 1))).astype(int)
+    gamma = (aleph-k).clip(0,1)
+    quantiles = (1.-gamma)*np.take_along_axis(x, k-1, axis=-1) + gamma*np.take_along_axis(x, k, axis=-1)
+    #a single value is every quantile
+    quantiles = np.where(n == 1, x[..., :1], quantiles)
+    return np.where(n == 0, np.nan, quantiles)
+
+#min, mean, max and empirical quantiles along the last axis of an array, na values are left out of the min, mean and max
+#and n is passed to cunnaneQuantiles. Returns an array with the last axis replaced by min, mean, max then one column per prob
+def getBands(values, prob, n=None):
+    with np.errstate(invalid='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        arrMin = np.nanmin(values, axis=-1)
+        #nanmean adds up in memory order, pass values laid out as the table they replace to get the same means as pandas
+        arrMean = np.nanmean(values, axis=-1)
+        arrMax = np.nanmax(values, axis=-1)
+    return np.concatenate([np.stack([arrMin, arrMean, arrMax], axis=-1), cunnaneQuantiles(values, prob, n)], axis=-1)
+
 #get monthly average of obsSim column
-def getStatus(df):
-    monthlyMeans =  df.groupby(['year','month'], as_index=False)[varName].mean()
+def getStatus(monthlyMeans, varName):
+    monthlyMeans = monthlyMeans.copy()
     monthlyMeans['month'] = monthlyMeans['month'].apply(lambda x: '{0:0>2}'.format(x))
     monthlyMeans['date'] = monthlyMeans['year'].astype(str) + '-' + monthlyMeans['month'].astype(str)
     status = monthlyMeans[['date',varName]]
     return status
 
-
-#get percentiles of monthly obsSim data to make the status climatology categories
-def createStatusBands(df):
-    bands = pd.DataFrame()
-    monthlyMeans = df.groupby(['year','month'], as_index=False)[varName].mean()
-    pivotedMeans = monthlyMeans.pivot(index='month', columns='year', values=varName)
-    bands['min'] = pivotedMeans.min(axis=1)
-    bands['mean'] = pivotedMeans.mean(axis=1)
-    bands['max'] = pivotedMeans.max(axis=1)
-    bands['month'] = bands.index
-    empirical_quantiles = mquantiles(pivotedMeans, prob=[.05,.10,.25,.75,.90,.95], alphap=.4, betap=.4, axis=1)
-    bands['5%'] = empirical_quantiles[:,0]
-    bands['10%'] = empirical_quantiles[:,1]
-    bands['25%'] = empirical_quantiles[:,2]
-    bands['75%'] = empirical_quantiles[:,3]
-    bands['90%'] = empirical_quantiles[:,4]
-    bands['95%'] = empirical_quantiles[:,5]
-    return bands
-
-#for all ENS columns, get monthly accumulated average
-def getAccumulatedForecasts(df):
-    accumulatedMonthlyMeans = pd.DataFrame()
-    accumulatedMonthlyMeans['date'] = df['date']
-    columns = df.columns.values
-    ens_columns = list(filter(lambda k: 'ENS' in k, columns))
-    for column in ens_columns:
-        accumulatedMonthlyMeans[column] = df[column].expanding().mean()
-    output_columns = ens_columns
-    output_columns.insert(0,'date')
-    accumulatedMonthlyMeans.columns = output_columns
-    return accumulatedMonthlyMeans
-
-#get percentiles of accumulated monthly data to make the forecast climatology categories
-def createAccumulatedForecastBands(df):
-    bands = pd.DataFrame()
-    monthlyMeans = df.groupby(['year','month'], as_index=False)[varName].mean()
-    reshapedDF = pd.DataFrame()
-    start = obsSimSlice
-    ticker = obsSimSlice
-    for i in range(start,len(monthlyMeans.index)):
-        if (i + 1) % 12 == ticker:  # the modulo operation
-            reshapedDF['Obs'+str(start)] = monthlyMeans[varName].iloc[start:i+1].values.reshape(12)
-            start = i + 1  # set start to next index
-    accumulatedMean = pd.DataFrame()
-    for column in reshapedDF:
-        accumulatedMean[column] = reshapedDF[column].expanding().mean()
-    bands['min'] = accumulatedMean.min(axis=1)
-    bands['mean'] = accumulatedMean.mean(axis=1)
-    bands['max'] = accumulatedMean.max(axis=1)
-    #compute empirical quantiles 
-    empirical_quantiles = mquantiles(accumulatedMean, prob=[.05,.10,.25,.75,.90,.95], alphap=.4, betap=.4, axis=1)
-    bands['5%'] = empirical_quantiles[:,0]
-    bands['10%'] = empirical_quantiles[:,1]
-    bands['25%'] = empirical_quantiles[:,2]
-    bands['75%'] = empirical_quantiles[:,3]
-    bands['90%'] = empirical_quantiles[:,4]
-    bands['95%'] = empirical_quantiles[:,5]
-    bands['relative_month']=bands.index+1
-    return bands
-
-#get percentiles of single monthly data to make the forecast climatology categories
-def createSingleForecastBands(df):
-    bands = pd.DataFrame()
-    monthlyMeans = df.groupby(['year','month'], as_index=False)[varName].mean()
-    reshapedDF = pd.DataFrame()
-    start = obsSimSlice
-    ticker = obsSimSlice
-    for i in range(start,len(monthlyMeans.index)):
-        if (i + 1) % 12 == ticker:  # the modulo operation
-            reshapedDF['Obs'+str(start)] = monthlyMeans[varName].iloc[start:i+1].values.reshape(12)
-            start = i + 1  # set start to next index
-    #row one of reshaped Df witll be the yearly values of forecast month for different years
-    bands['min'] = reshapedDF.min(axis=1)
-    bands['mean'] = reshapedDF.mean(axis=1)
-    bands['max'] = reshapedDF.max(axis=1)
-    #compute empirical quantiles 
-    empirical_quantiles = mquantiles(reshapedDF, prob=[.05,.10,.25,.75,.90,.95], alphap=.4, betap=.4, axis=1)
-    bands['5%'] = empirical_quantiles[:,0]
-    bands['10%'] = empirical_quantiles[:,1]
-    bands['25%'] = empirical_quantiles[:,2]
-    bands['75%'] = empirical_quantiles[:,3]
-    bands['90%'] = empirical_quantiles[:,4]
-    bands['95%'] = empirical_quantiles[:,5]
-    bands['relative_month']=bands.index+1
-    return bands
-
-
-#get the percentiles and min, mean and max, of the ENS columns for the HydroSOS percentages graphs
-def getForecastPercentiles(forecasts):
-    columns = forecasts.columns.values
-    columns = list(filter(lambda k: 'ENS' in k, columns))
-    arr = forecasts[columns]
-    arrMin = arr.min(axis=1)
-    arrMean = arr.mean(axis=1)
-    arrMax = arr.max(axis=1)
-    empirical_quantiles = mquantiles(arr, prob=[.10,.25,.75,.90], alphap=.4, betap=.4, axis=1)
-    percentile10 = empirical_quantiles[:,0]
-    percentile25 = empirical_quantiles[:,1]
-    percentile75 = empirical_quantiles[:,2]
-    percentile90 = empirical_quantiles[:,3]
-    percentiles = pd.DataFrame({'date':forecasts['date'],'min':arrMin,'mean':arrMean,'max':arrMax,'10%':percentile10,'25%':percentile25,'75%':percentile75,'90%':percentile90})
-    return percentiles
-
-#count up how many of the ENS columns for a month fit into each of the forecast bands for the counts graphs
-def getForecastCounts(percentiles, forecasts, bands): 
-    forecasts.index = range(len(forecasts))
-    columns = forecasts.columns.values
-    Ens_data_cat = pd.DataFrame(columns=columns)
-    Ens_data_cat.set_index(columns[0])
-    columns = list(filter(lambda k: 'ENS' in k, columns))
-    for idx, row in forecasts.iterrows():
-        output = []
-        output.append(row['date'])
-        for column in columns:
-            if (row[column] < bands.iloc[idx][percentiles[0]]):
-                output.append(int(1))
-            elif bands.iloc[idx][percentiles[0]] <= row[column] < bands.iloc[idx][percentiles[1]]:
-                output.append(int(2))
-            elif bands.iloc[idx][percentiles[1]] <= row[column] < bands.iloc[idx][percentiles[2]]:
-                output.append(int(3))
-            elif bands.iloc[idx][percentiles[2]] <= row[column] < bands.iloc[idx][percentiles[3]]:
-                output.append(int(4))
-            elif (row[column] >= bands.iloc[idx][percentiles[3]]):
-                output.append(int(5))
-        Ens_data_cat.loc[len(Ens_data_cat)] = output
-    counts = pd.DataFrame(columns=['date','notLow','belNorm','norm','abNorm','notHigh'])
-    for index, row in Ens_data_cat.iterrows():
-        counts.loc[len(counts)] = [row.iloc[0],sum(row==1),sum(row==2),sum(row==3),sum(row==4),sum(row==5)]
+#expanding mean down the second axis of a (catchment x month x column) array, for every catchment/column at once
+def expandingMean(values):
+    catchments, months, columns = values.shape
+    series = pd.DataFrame(values.transpose(1, 0, 2).reshape(months, catchments * columns))
+    return series.expanding().mean().to_numpy().reshape(months, catchments, columns).transpose(1, 0, 2)
+
+#for all members, get monthly accumulated average
+def getAccumulatedForecasts(cube):
+    return cube._replace(values=expandingMean(cube.values))
+
+#get the status bands of every catchment from their (months, monthly, values) climatology arrays
+#returns a (catchment x month x BAND_COLUMNS) array, na for catchments without obssim data
+def getStatusBands(climatologies):
+    statusBands = np.full((len(climatologies), 12, len(BAND_COLUMNS)), np.nan)
+    #catchments with the same number of years are stacked and banded together
+    groups = {}
+    for i, climatology in enumerate(climatologies):
+        if climatology is not None:
+            groups.setdefault(climatology[1].shape[1], []).append(i)
+    #na monthly means count as values in the quantiles, as they always have. The stack is laid out in memory the same way as
+    #the pivoted table was, so the means are added up in the same order
+    for years, indices in groups.items():
+        statusBands[indices] = getBands(np.ascontiguousarray(np.stack([climatologies[i][1] for i in indices])), BAND_PROB, years)
+    return statusBands
+
+#get the single and accumulated forecast bands of every catchment for forecasts starting obsSimSlice months into the obssim data
+#returns two (catchment x relative month x BAND_COLUMNS) arrays, na for catchments without obssim data
+def getForecastBands(climatologies, obsSimSlice):
+    singleBands = np.full((len(climatologies), 12, len(BAND_COLUMNS)), np.nan)
+    accumulatedBands = singleBands.copy()
+    reshaped = [reshapeClimatology(climatology[2], obsSimSlice) if climatology is not None else None for climatology in climatologies]
+    groups = {}
+    for i, catchmentReshaped in enumerate(reshaped):
+        if catchmentReshaped is not None and len(catchmentReshaped) > 0:
+            groups.setdefault(len(catchmentReshaped), []).append(i)
+    for years, indices in groups.items():
+        #(catchment x relative month x year) view of the (catchment x year x relative month) stack, the years are one row apart
+        #in memory as they were in the reshaped table
+        stack = np.ascontiguousarray(np.stack([reshaped[i] for i in indices])).transpose(0, 2, 1)
+        singleBands[indices] = getBands(stack, BAND_PROB, years)
+        accumulatedBands[indices] = getBands(expandingMean(stack), BAND_PROB, years)
+    return singleBands, accumulatedBands
+
+#a catchment's status bands table, one row per month in its obssim data
+def statusBandsTable(bands, months):
+    table = pd.DataFrame(bands[months - 1], columns=BAND_COLUMNS)
+    table.insert(3, 'month', months)
+    return table
+
+#a catchment's single or accumulated forecast bands table, one row per relative month
+def forecastBandsTable(bands):
+    table = pd.DataFrame(bands, columns=BAND_COLUMNS)[['min', 'mean', 'max', '10%', '25%', '75%', '90%']]
+    table.insert(0, 'relative_month', np.arange(1, len(table.index) + 1))
+    return table
+
+#get the percentiles and min, mean and max, of the members for the HydroSOS percentages graphs
+#returns a (catchment x lead month x PERCENTILE_COLUMNS) array, members a catchment doesn't have are na so are left out
+def getForecastPercentiles(cube):
+    return getBands(cube.values, [.10,.25,.75,.90])
+
+#count up how many of the members for a month fit into each of the forecast bands for the counts graphs
+#edges is the (catchment x lead month x 4) array of each catchment's band edges, returns a (catchment x lead month x COUNT_COLUMNS) array,
+#na for lead months with an na band edge (e.g. less than a full year of obssim data) as their members can't be categorised
+def getForecastCounts(cube, edges): 
+    catchments, leadMonths, members = cube.values.shape
+    #bin the whole cube, the category is 1 + the number of band edges at or below the member's value
+    categories = (cube.values[..., None] >= edges[:, :, None, :]).sum(axis=3)
+    #count each catchment and lead month's categories with one bincount, missing members aren't counted
+    cells = np.broadcast_to(np.arange(catchments * leadMonths).reshape(catchments, leadMonths, 1), cube.values.shape)
+    valid = ~np.isnan(cube.values)
+    counts = np.bincount((cells * 5 + categories)[valid], minlength=catchments * leadMonths * 5).reshape(catchments, leadMonths, 5).astype(float)
+    counts[np.isnan(edges).any(axis=2)] = np.nan
     return counts
 
+#a catchment's (lead month x COUNT_COLUMNS) counts as a table, whole numbers with the na counts left empty
+def countsTable(dates, counts):
+    table = catchmentTable(dates, counts, COUNT_COLUMNS)
+    return table.astype({column: 'Int64' if np.isnan(counts).any() else 'int64' for column in COUNT_COLUMNS})
+
+#the band edges the members are counted against, the 10%, 25%, 75% and 90% columns of a (catchment x month x BAND_COLUMNS) array
+def bandEdges(bands):
+    return bands[..., [BAND_COLUMNS.index(c) for c in ['10%','25%','75%','90%']]]
+
+#add the date, year and month columns the obssim data is aggregated by
+def addDateParts(statusDF):
+    statusDF['date'] = pd.to_datetime(statusDF['Date'])
+    statusDF['year'] = statusDF['date'].dt.year.astype(int)
+    statusDF['month'] = statusDF['date'].dt.month.astype(int)
+    return statusDF
+
+#read an obssim file, with its date parts added
+def readStatus(settings, f):
+    if settings.inputFormat == 'parquet':
+        return addDateParts(pd.read_parquet(f"{settings.status_directory}/{f}"))
+    return addDateParts(readInputCsv(settings, f"{settings.status_directory}/{f}", "%d/%m/%Y"))
+
+#write df as csv text and read it back, as a csv written by to_csv and read by read_csv
+def csvRoundTrip(df):
+    return pd.read_csv(io.StringIO(df.to_csv(index=False)))
+
+#read a catchment's combined ESP file once, returning its forecasts (as readCatchmentForecasts) and its obssim data (as readStatus)
+def readCatchmentESP(settings, filename):
+    statusDF, monthlyDF = splitESP(pd.read_csv(f"{settings.forecast_directory}/{filename}"), settings.varName)
+    #the obssim dates are parsed as they are when reformatESP's obsDir csvs are read
+    try:
+        statusDF['Date'] = pd.to_datetime(statusDF['Date'], format="%d/%m/%Y")
+    except ValueError:
+        statusDF['Date'] = pd.to_datetime(statusDF['Date'])
+    #members are in the order reformatESP's ESP_{ENS}_{id}.csv files would be listed in
+    names = sorted([col for col in monthlyDF.columns if 'ENS' in col], key=lambda col: col + '_')
+    #the obssim and member means go through the csv text reformatESP writes and read_csv reads back, which isn't exact to the last bit,
+    #so the bands match reformatESP followed by forecastcalc
+    statusDF[settings.varName] = csvRoundTrip(statusDF[[settings.varName]])[settings.varName].to_numpy()
+    forecasts = pd.DatetimeIndex(monthlyDF['Date']), names, csvRoundTrip(monthlyDF[names])[names].to_numpy(dtype=float)
+    return forecasts, addDateParts(statusDF)
+
+#aggregate a catchment's obssim data once for the status, single and accumulated bands and write its status
+#returns its (months, monthly, values) climatology arrays as the bands are calculated for all catchments at once, None without obssim data
+def catchmentClimatology(settings, cid, statusDFs):
+    climatology = None
+    for statusDF in statusDFs:
+        climatology = getClimatology(statusDF, settings.varName)
+        #write the status data
+        status = getStatus(climatology[0], settings.varName)
+        writeOutput(settings, status, 'status/status', cid, 'status', float_format='%.4f', columns=['date',settings.varName])
+    return climatology[1:] if climatology else None
+
+#read a (catchment id, files) task's forecasts and obssim data and write its status
+#returns the catchment id, its forecasts, its climatology and the process id
+def processCatchment(task, settings):
+    cid, catchmentFiles = task
+    if settings.inputFormat == 'esp':
+        forecasts, statusDF = readCatchmentESP(settings, catchmentFiles['status'][0])
+        statusDFs = [statusDF]
+    else:
+        forecasts = readCatchmentForecasts(settings, cid, catchmentFiles)
+        statusDFs = (readStatus(settings, f) for f in catchmentFiles['status'])
+    return cid, forecasts, catchmentClimatology(settings, cid, statusDFs), os.getpid()
+
+#read a (catchment id, obssim files) task's obssim data and write its status, for hindcasts
+#returns the catchment id, its climatology and the process id
+def processClimatology(task, settings):
+    cid, statusFiles = task
+    return cid, catchmentClimatology(settings, cid, (readStatus(settings, f) for f in statusFiles)), os.getpid()
+
+#read a (catchment id, files) task's forecasts, for hindcasts, returns the catchment id, its forecasts and the process id
+def processForecasts(task, settings):
+    cid, catchmentFiles = task
+    return cid, readCatchmentForecasts(settings, cid, catchmentFiles), os.getpid()
+
+#calculate the accumulated forecasts, percentiles and counts of every catchment and return their output tables as writeCatchmentOutputs tasks
+#singleBands and accumulatedBands are the catchments' (catchment x relative month x BAND_COLUMNS) bands, hasStatus marks the catchments with
+#obssim data, only their bands, percentiles and counts are written. prefix is the forecast start date subdirectory in hindcast mode
+def forecastOutputs(catchments, forecasts, singleBands, accumulatedBands, hasStatus, prefix=''):
+    #stack every catchment's members into one cube, the accumulated forecasts, percentiles and counts are calculated for all of them at once
+    single_forecasts = buildEnsembleCube(catchments, forecasts)
+    accumulated_forecasts = getAccumulatedForecasts(single_forecasts) #GOOD
+    singleForecastPercentiles = getForecastPercentiles(single_forecasts) #GOOD
+    accumulatedForecastPercentiles = getForecastPercentiles(accumulated_forecasts) #GOOD
+    #the forecasts are counted against the bands of their lead months
+    leadMonths = len(single_forecasts.dates)
+    accumulatedCounts = getForecastCounts(accumulated_forecasts, bandEdges(accumulatedBands)[:, :leadMonths])
+    singleCounts = getForecastCounts(single_forecasts, bandEdges(singleBands)[:, :leadMonths])
+
+    outputs = []
+    for i, cid in enumerate(single_forecasts.catchments):
+        catchmentOutputs = [(catchmentForecasts(accumulated_forecasts, i), prefix+'accumulated/forecasts', 'forecasts', '%.4f'),
+                            (catchmentForecasts(single_forecasts, i), prefix+'single/forecasts', 'forecasts', None)]
+        if hasStatus[i]:
+            dates = single_forecasts.dates
+            catchmentOutputs += [(forecastBandsTable(accumulatedBands[i]), prefix+'accumulated/forecastBands', 'bands', '%.4f'),
+                                 (forecastBandsTable(singleBands[i]), prefix+'single/forecastBands', 'bands', '%.4f'),
+                                 (catchmentTable(dates, accumulatedForecastPercentiles[i], PERCENTILE_COLUMNS), prefix+'accumulated/percentiles', 'percentiles', '%.4f'),
+                                 (countsTable(dates, accumulatedCounts[i]), prefix+'accumulated/counts', 'counts', None),
+                                 (catchmentTable(dates, singleForecastPercentiles[i], PERCENTILE_COLUMNS), prefix+'single/percentiles', 'percentiles', '%.4f'),
+                                 (countsTable(dates, singleCounts[i]), prefix+'single/counts', 'counts', None)]
+        outputs.append((cid, catchmentOutputs))
+    return outputs
+
+#the status bands output tables of the catchments with obssim data, as writeCatchmentOutputs tasks
+def statusBandsOutputs(catchments, climatologies):
+    statusBands = getStatusBands(climatologies)
+    return [(cid, [(statusBandsTable(statusBands[i], climatologies[i][0]), 'status/statusBands', 'bands', '%.4f')])
+            for i, cid in enumerate(catchments) if climatologies[i] is not None]
+
+#write a (catchment id, [(table, subdirectory, suffix, float_format), ...]) task's output tables
+def writeCatchmentOutputs(task, settings):
+    cid, outputs = task
+    for df, subdirectory, suffix, float_format in outputs:
+        writeOutput(settings, df, subdirectory, cid, suffix, float_format=float_format)
+
 
 ##############################################
 # Main 
 ##############################################
 
-print("Main:")
-
-#get a set of all the catchment IDs to loop through later...
-catchmentList = []
-for filename in os.listdir(forecast_directory):
-    if filename.endswith('.csv'): 
-        filenameParts = filename.split('_')
-        catchmentID = filenameParts[2]
-        catchmentList.append(catchmentID)
-
-catchmentIDs = set(catchmentList)
-
-
-# for catchment in the set above...
-idCounter = 1 
-for id in catchmentIDs:
-    cid = id.split('.csv')[0]
-    print(f"Processing {id} ({idCounter}/{len(catchmentIDs)}).")
-    idCounter += 1 
-    # create a new dataframe to hold all the ENS runs as they're all separate atm
-    fullDF = pd.DataFrame()
-    # columns to export for full ens csv
-    columns = ['date']
-    # loop through the whole forecast folder
-    for filename in os.listdir(forecast_directory):
-        if filename.endswith('.csv'): 
-            filenameParts = filename.split('_')
-            catchmentID = filenameParts[2]
-            # if the catchment id matches the filename
-            if catchmentID == id: 
-                # add the ENS to the columns for the export, include the letters ENS if they are missing
-                if 'ENS' not in filenameParts[1]:
-                    ENS = 'ENS'+filenameParts[1]
-                else:
-                    ENS = filenameParts[1]
-                columns.append(ENS)
-                # open the forecast file and add it to the fullDF to export.
-                with open(forecast_directory+'/'+filename, mode="r") as fr:
-                    csvFile = pd.read_csv(fr, parse_dates=['Date'],  date_format="%Y-%m")
-                    df = pd.DataFrame(csvFile)
-                    df['date'] = pd.to_datetime(df['Date'])
-                    df['year'] = df['date'].dt.year.astype(float)
-                    df['month'] = df['date'].dt.month.astype(float)
-                    df['year'] = df['date'].dt.year.astype(int)
-                    df['month'] = df['date'].dt.month.astype(int)
-                    fullDF['date'] = df['date']
-                    fullDF['year'] = df['year']
-                    fullDF['month'] = df['month']
-                    fullDF[ENS] = df[varName] # add the value for this ensemble member to the full df.
-   
-    #export the full forecast with all the ensemble members
-    fullDF.reset_index()
-    fullDF['month'] = fullDF['month'].astype(int).apply(lambda x: '{0:0>2}'.format(x))
-    fullDF['date'] = fullDF['year'].astype(str) + '-' + fullDF['month'].astype(str)
-    
-    #once have the ENS all in one file, use it to create accumulated forecasts
-    accumulated_forecasts = getAccumulatedForecasts(fullDF) #GOOD
-    accumulated_forecasts.to_csv(output_directory +'/accumulated/forecasts/'+ cid +'_forecasts.csv', header=True, index=False, float_format='%.4f')
-     
-    #single forecasts is just fullDF minus year and month
-    fullDF.to_csv(output_directory+'/single/forecasts/'+ cid +'_forecasts.csv', index=False, columns=columns)
-    single_forecasts = fullDF.drop(columns=['year','month'])
-
-    # no compute counts of accumulated and single forecasts
-    status_files = os.listdir(status_directory)
-    for f in status_files:
-        #in status files, the first underscore split contains the catchment id
-        if f.split('_')[1] == id:
-            with open(f"{status_directory}/{f}", mode="r") as status_fr:
-                statusDF = pd.read_csv(status_fr, parse_dates=['Date'], date_format="%d/%m/%Y")
-                statusDF['date'] = pd.to_datetime(statusDF['Date'])
-                statusDF['year'] = statusDF['date'].dt.year.astype(float)
-                statusDF['month'] = statusDF['date'].dt.month.astype(float)
-                statusDF['year'] = statusDF['date'].dt.year.astype(int)
-                statusDF['month'] = statusDF['date'].dt.month.astype(int)
-            #write the status data
-            status = getStatus(statusDF)
-            status.to_csv(output_directory +'/status/status/'+ cid +'_status.csv', header=True, index = False, float_format='%.4f', columns=['date',varName])
-            statusBands = createStatusBands(statusDF)
-            statusBands.to_csv(output_directory+'/status/statusBands/'+ cid +'_bands.csv', index=False, float_format='%.4f')
-            #write accumulated forecasts
-            accumulatedForecastBands = createAccumulatedForecastBands(statusDF) #GOOD
-            accumulatedForecastBands.to_csv(output_directory +'/accumulated/forecastBands/'+ cid +'_bands.csv', index=False, float_format='%.4f', columns =['relative_month', 'min', 'mean', 'max', '10%', '25%', '75%', '90%'])
-            accumulatedForecastPercentiles = getForecastPercentiles(accumulated_forecasts) #GOOD
-            accumulatedForecastPercentiles.to_csv(output_directory +'/accumulated/percentiles/'+ cid +'_percentiles.csv', header=True, index = False, float_format='%.4f')
-            accumulatedCounts = getForecastCounts(['10%','25%','75%','90%'], accumulated_forecasts, accumulatedForecastBands)
-            accumulatedCounts.to_csv(output_directory +'/accumulated/counts/'+ cid +'_counts.csv', index=False)
-            #write single forecasts
-            singleForecastBands = createSingleForecastBands(statusDF)
-            singleForecastBands.to_csv(output_directory +'/single/forecastBands/'+ cid +'_bands.csv', index=False, float_format='%.4f', columns =['relative_month', 'min', 'mean', 'max', '10%', '25%', '75%', '90%'])
-            singleForecastPercentiles = getForecastPercentiles(single_forecasts) #GOOD
-            singleForecastPercentiles.to_csv(output_directory +'/single/percentiles/'+ cid +'_percentiles.csv', header=True, index = False, float_format='%.4f')
-            singleCounts = getForecastCounts(['10%','25%','75%','90%'], single_forecasts, singleForecastBands)
-            singleCounts.to_csv(output_directory +'/single/counts/'+ cid +'_counts.csv', index=False)
-            
-print("**************************************")
+def main():
+    print("**************************************")
+    print("Input:")
+    print("Parsing arguments.")
+
+    parser = argparse.ArgumentParser(
+                        prog='ForecastCalc PYTHON',
+                        description='Calculates forecast based on daily timeseries for the HydroSOS portal',
+                        epilog='Gemma N, Ezra K, UKCEH, 25057024')
+
+    parser.add_argument('obs_dir', help='directory containing obsserved simulated (obssim) data as timeseries, should ONLY contain .csv daily timeseries, filenames should be formatted X_CATCHMENTID.csv see GitHub for examples.')        
+    parser.add_argument('forecast_dir', help='directory containing forecast data for the next X months, should only contain .csv monthly forecasts, filenames should be formatted X_ENS_CATCHMENTID.csv, see GitHub for examples.')     
+    parser.add_argument('output_dir', help=
+                        'directory files will be saved to. Four sub directories will be created in this directory forecastBand, forecasts, counts and percentiles') 
+    parser.add_argument('--obsDirStartingMonth', help='Starting month in the obsDir dataset (default january)') 
+    parser.add_argument('--varName', help='Name of the variable in your data files, default is Discharge') 
+    parser.add_argument('--inputFormat', help='csv (default), parquet or esp, parquet reads obs_dir (Date, varName columns) and forecast_dir (Date, ENS, varName columns) as datasets partitioned by stationID, esp reads the obssim data and members straight from the combined ESP csvs in forecast_dir (obs_dir is not read)') 
+    parser.add_argument('--forecastDate', help='with --inputFormat esp, only read the combined ESP files for this forecast date (YYYY-MM), as reformatESP.py does (default every file in forecast_dir, which must then hold one file per catchment)') 
+    parser.add_argument('--outputFormat', help='csv (default) or parquet, parquet writes each output as a dataset partitioned by stationID instead of one csv per catchment') 
+    parser.add_argument('--workers', help='number of catchments to process in parallel (default 1)') 
+    parser.add_argument('--hindcast', help='if 1, forecast_dir contains one subdirectory of forecasts per forecast start date (e.g. 2001-02) and the forecast outputs of each are written to the same subdirectory of output_dir, the obssim climatology is only calculated once for all of them') 
+    parser.add_argument('--cacheDirectory', help='if set, parsed input csvs are cached in this directory and later runs only re-parse files that have changed') 
+
+
+    args = parser.parse_args()
+    forecast_directory = args.forecast_dir
+    status_directory = args.obs_dir
+    output_directory = args.output_dir
+    inputFormat = args.inputFormat if args.inputFormat else 'csv'
+    outputFormat = args.outputFormat if args.outputFormat else 'csv'
+    if args.hindcast == "1" and inputFormat == 'esp':
+        parser.error("--hindcast can't be used with --inputFormat esp, each combined ESP file has its own obssim data")
+    if inputFormat == 'esp':
+        #without --forecastDate every file is read, files for several forecast dates would otherwise overwrite each other
+        try:
+            espCatchmentFiles(forecast_directory, args.forecastDate)
+        except ValueError as e:
+            parser.error(f"{e}, use --forecastDate to pick one forecast date")
+
+    if args.workers:
+        workers = int(args.workers)
+    else:
+        workers = 1
+
+    #check the variable name to use
+    if args.varName:
+        varName=args.varName
+    else:
+        varName='Discharge'
+
+    settings = Settings(forecast_directory, status_directory, output_directory, inputFormat, outputFormat, varName,
+                        args.obsDirStartingMonth, args.forecastDate, args.cacheDirectory)
+
+    print('Making output directories.')
+    Path(output_directory+'/status/status').mkdir(parents=True, exist_ok=True)
+    Path(output_directory+'/status/statusBands').mkdir(parents=True, exist_ok=True)
+
+    if args.obsDirStartingMonth:
+        print(f"Obs Dir Starting month set as {int(args.obsDirStartingMonth)}.")
+    else:
+        print(f"Obs Dir Starting month set as january.")
+
+    if args.hindcast == "1":
+        #every subdirectory of forecast_dir is a forecast start date
+        forecastStarts = sorted(d for d in os.listdir(forecast_directory) if os.path.isdir(f"{forecast_directory}/{d}"))
+        print(f"Hindcast of {len(forecastStarts)} forecast start dates. \n")
+    else:
+        makeOutputDirectories(settings)
+        forecast_month = getForecastMonth(settings, forecast_directory)
+        print(f"First forecast month set as {forecast_month}. \n")
+        obsSimSlice = getObsSimSlice(settings, forecast_month)
+        print(f"Obs sim slicing starts from row {obsSimSlice}")
+
+    print("Main:")
+
+    #catchments are independent until they are stacked into the cube, so reading them and writing their outputs can be
+    #shared over a process pool, results come back in catchment order so the outputs don't depend on workers
+    with ProcessPoolExecutor(max_workers=workers) if workers > 1 else nullcontext() as executor:
+        def runTasks(function, tasks):
+            function = partial(function, settings=settings)
+            if workers > 1:
+                return executor.map(function, tasks, chunksize=max(1, len(tasks) // (workers * 4)))
+            return map(function, tasks)
+
+        if args.hindcast == "1":
+            #index each start date's forecasts, the obssim data of every catchment in any of them is only read and aggregated once
+            catchmentIndexes = {start: buildCatchmentIndex(settings, start + '/') for start in forecastStarts}
+            statusFiles = {}
+            for catchmentIndex in catchmentIndexes.values():
+                for cid, catchmentFiles in catchmentIndex.items():
+                    statusFiles.setdefault(cid, catchmentFiles['status'])
+            tasks = list(statusFiles.items())
+            if workers > 1:
+                print(f"Processing {len(tasks)} catchments with {workers} workers.")
+            results = []
+            for idCounter, result in enumerate(runTasks(processClimatology, tasks), 1):
+                print(f"Processed the obssim data of {result[0]} ({idCounter}/{len(tasks)})" + (f" on worker {result[2]}." if workers > 1 else "."))
+                results.append(result)
+            catchments = [result[0] for result in results]
+            catchmentIdx = {cid: i for i, cid in enumerate(catchments)}
+            climatologies = [result[1] for result in results]
+            for _ in runTasks(writeCatchmentOutputs, statusBandsOutputs(catchments, climatologies)):
+                pass
+
+            #the forecast bands only depend on the forecast month, so are calculated once for each of them
+            forecastBands = {}
+            for startCounter, start in enumerate(forecastStarts, 1):
+                obsSimSlice = getObsSimSlice(settings, getForecastMonth(settings, f"{forecast_directory}/{start}"))
+                if obsSimSlice not in forecastBands:
+                    forecastBands[obsSimSlice] = getForecastBands(climatologies, obsSimSlice)
+                results = list(runTasks(processForecasts, list(catchmentIndexes[start].items())))
+                rows = [catchmentIdx[result[0]] for result in results]
+                singleBands, accumulatedBands = (bands[rows] for bands in forecastBands[obsSimSlice])
+                makeOutputDirectories(settings, start + '/')
+                outputs = forecastOutputs([result[0] for result in results], [result[1] for result in results], singleBands, accumulatedBands,
+                                          [climatologies[row] is not None for row in rows], start + '/')
+                for _ in runTasks(writeCatchmentOutputs, outputs):
+                    pass
+                print(f"Forecast start {start} ({startCounter}/{len(forecastStarts)}): obs sim slicing from row {obsSimSlice}, wrote the forecasts of {len(outputs)} catchments.")
+        else:
+            #index the forecast and obssim files of every catchment, listing each directory once
+            catchmentIndex = buildCatchmentIndex(settings)
+            tasks = list(catchmentIndex.items())
+            if workers > 1:
+                print(f"Processing {len(tasks)} catchments with {workers} workers.")
+            results = []
+            for idCounter, result in enumerate(runTasks(processCatchment, tasks), 1):
+                print(f"Processed {result[0]} ({idCounter}/{len(tasks)})" + (f" on worker {result[3]}." if workers > 1 else "."))
+                results.append(result)
+
+            #the bands, percentiles and counts are calculated for all catchments at once
+            catchments = [result[0] for result in results]
+            climatologies = [result[2] for result in results]
+            singleBands, accumulatedBands = getForecastBands(climatologies, obsSimSlice)
+            outputs = forecastOutputs(catchments, [result[1] for result in results], singleBands, accumulatedBands,
+                                      [climatology is not None for climatology in climatologies])
+            outputs += statusBandsOutputs(catchments, climatologies)
+            print(f"Writing the forecasts of {len(catchments)} catchments.")
+            for _ in runTasks(writeCatchmentOutputs, outputs):
+                pass
+
+    print("**************************************")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+"""
+Hydrobasin label rasters, used by forecast/forecast_to_geotiff.py and other/outlastnc_proc.py.
+
+Rather than rasterising the basin polygons again for every month, the joined basins are rasterised once into a label grid holding
+the row (+1) of the basin that owns each pixel, 0 where there is no basin. Each month's grid is then a lookup of the basin values
+by label. The labels are burnt with the same geocube settings as the monthly grids were, in row order with later basins replacing
+earlier ones, so the geotiffs are unchanged.
+
+For fine resolutions the global grid doesn't fit in memory, with a tile size (--tileSize) the labels are rasterised a strip of
+rows at a time into a memory mapped .npy and each month is looked up and written a strip at a time to a temporary tiled GeoTIFF,
+which GDAL then copies to the COG, so memory is bounded by the tile size rather than the grid size.
+
+With a cache directory (--cacheDirectory) the shapefile's basin table (HYBAS_ID and bounds of each polygon) and the label grids
+are stored as .npy arrays and memory mapped on later runs, so the shapefile is only read again when it changes or a grid of new
+basins, resolution or extent is needed. Entries are keyed by a hash of the shapefile's contents, the cache directory can be
+deleted at any time.
+"""
+
+import atexit
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio
+import rasterio.features
+import rasterio.shutil
+import rasterio.windows
+import xarray as xr
+from geocube.api.core import make_geocube
+from geocube.geo_utils.geobox import GeoBoxMaker
+from geocube.rasterize import rasterize_image
+from rasterio.enums import MergeAlg
+from rioxarray.rioxarray import affine_to_coords
+
+LABEL_ATTRS = {'name': 'label', 'long_name': 'label', '_FillValue': 0}
+
+def readBasins(shapefile):
+    """
+    The hydrobasins shapefile as a geodataframe of HYBAS_IDs.
+    """
+    gdf = gpd.read_file(shapefile, include_fields=['HYBAS_ID'])
+    gdf['HYBAS_ID'] = gdf['HYBAS_ID'].astype('int').fillna(0)
+    return gdf
+
+def joinBasins(ids, basins):
+    """
+    Merges the shapefile HYBAS_IDs with the HYBAS_ID column of basins the way gdf.merge(basins) does,
+    returns the shapefile row and the basins row of each joined basin.
+    """
+    shapes = pd.DataFrame({'HYBAS_ID': ids, 'shape': np.arange(len(ids))})
+    joined = shapes.merge(basins.loc[:, ['HYBAS_ID']].assign(row=np.arange(len(basins))), left_on='HYBAS_ID', right_on='HYBAS_ID')
+    return joined['shape'].to_numpy(), joined['row'].to_numpy()
+
+def makeLabelGrid(gdf_join, resolution=(-0.05, 0.05), all_touched=True):
+    """
+    Rasterises the rows of gdf_join as labels 1..len(gdf_join), returns a dataset with a 'label' variable.
+    """
+    labels = gdf_join[['geometry']].assign(label=np.arange(1, len(gdf_join) + 1, dtype='int32'))
+    return make_geocube(
+        vector_data=labels,
+        measurements=['label'],
+        fill=0,
+        resolution=resolution,
+        rasterize_function=partial(rasterize_image, all_touched=all_touched)
+    )
+
+def makeTiledLabelGrid(gdf_join, labelPath, resolution=(-0.05, 0.05), all_touched=True, tileSize=1024):
+    """
+    makeLabelGrid for grids too big for memory, the labels are rasterised tileSize rows at a time into a .npy memory map at labelPath.
+    """
+    #the same grid make_geocube would make
+    geobox = GeoBoxMaker(output_crs=None, resolution=resolution, align=None, geom=None, like=None).from_vector(gdf_join)
+    labels = np.lib.format.open_memmap(labelPath, mode='w+', dtype='int32', shape=(geobox.height, geobox.width))
+    geometry = gdf_join.geometry.to_numpy()
+    bounds = gdf_join.bounds.to_numpy()
+    for row in range(0, geobox.height, tileSize):
+        window = rasterio.windows.Window(0, row, geobox.width, min(tileSize, geobox.height - row))
+        transform = rasterio.windows.transform(window, geobox.affine)
+        #only burn the basins overlapping the strip (with a pixel to spare), keeping their order
+        top = transform.f - transform.e
+        bottom = transform.f + (window.height + 1) * transform.e
+        inStrip = np.flatnonzero((bounds[:, 1] <= top) & (bounds[:, 3] >= bottom))
+        if len(inStrip):
+            labels[row:row + window.height] = rasterio.features.rasterize(
+                zip(geometry[inStrip], inStrip + 1),
+                out_shape=(window.height, window.width),
+                transform=transform,
+                fill=0,
+                all_touched=all_touched,
+                merge_alg=MergeAlg.replace,
+                dtype='int32'
+            )
+    labels.flush()
+    labelGrid = xr.Dataset(data_vars={'label': (('y', 'x'), labels, dict(LABEL_ATTRS), {'grid_mapping': 'spatial_ref'})},
+                           coords=affine_to_coords(geobox.affine, geobox.width, geobox.height))
+    labelGrid.rio.write_transform(geobox.affine, inplace=True)
+    labelGrid.rio.write_crs(str(geobox.crs), inplace=True)
+    labelGrid.rio.write_coordinate_system(inplace=True)
+    return labelGrid
+
+def shapefileHash(shapefile):
+    """
+    Hash of the contents of the shapefile and its sidecar files.
+    """
+    digest = hashlib.sha1()
+    shapefile = Path(shapefile)
+    paths = [shapefile] + [shapefile.with_suffix(suffix) for suffix in ['.shx', '.dbf', '.prj', '.cpg'] if suffix != shapefile.suffix]
+    for path in paths:
+        if path.exists():
+            digest.update(path.suffix.encode())
+            with open(path, 'rb') as fr:
+                for block in iter(partial(fr.read, 1 << 20), b''):
+                    digest.update(block)
+    return digest.hexdigest()
+
+def temporaryEntry(entry):
+    """
+    The directory an entry is written to before it's swapped in.
+    """
+    temporary = entry.with_name(f"{entry.name}.{os.getpid()}.tmp")
+    temporary.mkdir(parents=True, exist_ok=True)
+    return temporary
+
+def saveEntry(entry, arrays, meta, temporary=None):
+    """
+    Stores each array as .npy along with meta.json, swapping the entry in so a reader never sees a half written entry.
+    temporary may already hold other arrays of the entry.
+    """
+    temporary = temporary or temporaryEntry(entry)
+    for name, values in arrays.items():
+        np.save(temporary / f"{name}.npy", values, allow_pickle=False)
+    with open(temporary / 'meta.json', 'w') as fw:
+        json.dump(meta, fw)
+    shutil.rmtree(entry, ignore_errors=True)
+    os.replace(temporary, entry)
+
+def loadEntry(entry, names):
+    """
+    Memory maps the arrays of an entry, returns them with its meta.
+    """
+    with open(entry / 'meta.json', 'r') as fr:
+        meta = json.load(fr)
+    return [np.load(entry / f"{name}.npy", mmap_mode='r') for name in names], meta
+
+def saveLabelGrid(entry, gdf_join, resolution, all_touched, tileSize=None):
+    """
+    Makes the label grid of gdf_join and stores it in entry with the attributes needed to rebuild it identically.
+    """
+    temporary = temporaryEntry(entry)
+    arrays = {}
+    if tileSize:
+        labelGrid = makeTiledLabelGrid(gdf_join, temporary / 'label.npy', resolution, all_touched, tileSize)
+    else:
+        labelGrid = makeLabelGrid(gdf_join, resolution, all_touched)
+        arrays['label'] = labelGrid['label'].values
+    saveLabelGridEntry(entry, labelGrid, arrays, temporary)
+
+def saveLabelGridEntry(entry, labelGrid, arrays=None, temporary=None):
+    """
+    Stores labelGrid's coordinates, its labels unless they're already in temporary, and the attributes loadLabelGrid needs.
+    """
+    arrays = {'label': labelGrid['label'].values} if arrays is None else arrays
+    arrays.update(y=labelGrid['y'].values, x=labelGrid['x'].values)
+    saveEntry(entry, arrays, {name: labelGrid[name].attrs for name in ['y', 'x', 'spatial_ref']}, temporary)
+
+def loadLabelGrid(entry):
+    """
+    The label grid stored in entry, its labels memory mapped.
+    """
+    (labels, y, x), attrs = loadEntry(entry, ['label', 'y', 'x'])
+    return xr.Dataset(
+        data_vars={'label': (('y', 'x'), labels, dict(LABEL_ATTRS), {'grid_mapping': 'spatial_ref'})},
+        coords={'y': ('y', np.asarray(y), attrs['y']), 'x': ('x', np.asarray(x), attrs['x']), 'spatial_ref': ((), 0, attrs['spatial_ref'])}
+    )
+
+def basinLabelGrid(shapefile, basins, resolution=(-0.05, 0.05), all_touched=True, cacheDirectory=None, tileSize=None):
+    """
+    The label grid of the hydrobasins in shapefile joined with basins (a dataframe with a HYBAS_ID column),
+    and the basins row of each label so values in basins order can be looked up with values[rows].
+    If cacheDirectory is set the basin table and label grid are served from the cache when they've been made before.
+    If tileSize is set the labels are rasterised tileSize rows at a time and memory mapped from disk.
+    """
+    if not cacheDirectory:
+        gdf = readBasins(shapefile)
+        shapes, rows = joinBasins(gdf['HYBAS_ID'].to_numpy(), basins)
+        if not tileSize:
+            return makeLabelGrid(gdf.iloc[shapes], resolution, all_touched), rows
+        #the labels still need a home on disk, removed when the script finishes
+        temporary = tempfile.mkdtemp(prefix='basin_raster')
+        atexit.register(shutil.rmtree, temporary, ignore_errors=True)
+        entry = Path(temporary) / 'labels'
+        saveLabelGrid(entry, gdf.iloc[shapes], resolution, all_touched, tileSize)
+        return loadLabelGrid(entry), rows
+
+    gdf = None
+    shapefileDirectory = Path(cacheDirectory) / shapefileHash(shapefile)
+    if not (shapefileDirectory / 'basins' / 'meta.json').exists():
+        gdf = readBasins(shapefile)
+        saveEntry(shapefileDirectory / 'basins', {'HYBAS_ID': gdf['HYBAS_ID'].to_numpy(), 'bounds': gdf.bounds.to_numpy()}, {'shapefile': str(shapefile)})
+    (ids, bounds), _ = loadEntry(shapefileDirectory / 'basins', ['HYBAS_ID', 'bounds'])
+    shapes, rows = joinBasins(ids, basins)
+
+    #the grid depends on which polygons are burnt, in what order, as well as the resolution and extent,
+    #tiles are rasterised from their own origins so edges lying exactly on a pixel edge can round differently to the whole grid
+    extent = [float(np.min(bounds[shapes, 0])), float(np.min(bounds[shapes, 1])), float(np.max(bounds[shapes, 2])), float(np.max(bounds[shapes, 3]))]
+    key = json.dumps({'resolution': list(resolution), 'all_touched': all_touched, 'extent': extent, 'tileSize': tileSize, 'shapes': hashlib.sha1(shapes.astype('int64').tobytes()).hexdigest()})
+    entry = shapefileDirectory / hashlib.sha1(key.encode()).hexdigest()
+    if not (entry / 'meta.json').exists():
+        if gdf is None:
+            gdf = readBasins(shapefile)
+        saveLabelGrid(entry, gdf.iloc[shapes], resolution, all_touched, tileSize)
+    return loadLabelGrid(entry), rows
+
+def labelledGrid(labelGrid, values, name):
+    """
+    The grid make_geocube would give for measurement name with values in the same row order as the labels.
+    """
+    values = np.asarray(values)
+    #label 0 is the fill value
+    lookup = np.concatenate([np.zeros(1, dtype=values.dtype), values])
+    out_grid = labelGrid.drop_vars('label')
+    out_grid[name] = (('y', 'x'), lookup[labelGrid['label'].values],
+                      {'name': name, 'long_name': name, '_FillValue': 0}, {'grid_mapping': 'spatial_ref'})
+    return out_grid
+
+def writeTiledGeotiff(labelGrid, values, name, output_geotiff, tileSize):
+    """
+    writeLabelledGeotiff a strip of tileSize rows at a time, for label grids too big to look up in memory.
+    """
+    values = np.asarray(values)
+    lookup = np.concatenate([np.zeros(1, dtype=values.dtype), values]).astype(np.uint8)
+    labels = labelGrid['label'].data
+    height, width = labels.shape
+    #GDAL can only make a COG by copying a finished raster, so the strips are written to a temporary tiled GeoTIFF first
+    temporary = f"{output_geotiff}.{os.getpid()}.tmp.tif"
+    with rasterio.open(temporary, 'w', driver='GTiff', width=width, height=height, count=1, dtype=rasterio.uint8, nodata=0,
+                       crs=labelGrid.rio.crs, transform=labelGrid.rio.transform(recalc=True), tiled=True, blockxsize=512, blockysize=512,
+                       compress='lzw', BIGTIFF='IF_SAFER') as dst:
+        dst.update_tags(1, name=name, long_name=name, _FillValue=0)
+        dst.set_band_description(1, name)
+        for row in range(0, height, tileSize):
+            dst.write(lookup[labels[row:row + tileSize]], 1, window=rasterio.windows.Window(0, row, width, min(tileSize, height - row)))
+    rasterio.shutil.copy(temporary, output_geotiff, driver='COG')
+    os.remove(temporary)
+
+def writeLabelledGeotiff(labelGrid, values, name, output_geotiff, tileSize=None):
+    """
+    Writes the values of each labelled basin as a geotiff for the portal via mapserver (hydrosos_hydrobasins.map).
+    """
+    if tileSize:
+        writeTiledGeotiff(labelGrid, values, name, output_geotiff, tileSize)
+        return
+    #an 8 bit unsigned integer is enough to store all the data classes
+    labelledGrid(labelGrid, values, name).rio.to_raster(output_geotiff, driver="COG", tiled=True, windowed=True, dtype=rasterio.uint8)
+
+@lru_cache(maxsize=1)
+def workerLabelGrid(entry):
+    """
+    The label grid stored in entry, loaded once per worker process.
+    """
+    return loadLabelGrid(entry)
+
+def writeWorkerGeotiff(task, entry, tileSize=None):
+    """
+    writeLabelledGeotiff in a worker process, task is (values, name, output_geotiff).
+    """
+    writeLabelledGeotiff(workerLabelGrid(entry), *task, tileSize)
+
+def writeLabelledGeotiffs(labelGrid, tasks, tileSize=None, workers=1):
+    """
+    Writes the (values, name, output_geotiff) of each task with writeLabelledGeotiff, shared over workers processes.
+    """
+    if workers <= 1:
+        for task in tasks:
+            writeLabelledGeotiff(labelGrid, *task, tileSize)
+        return
+    #the workers memory map the labels from their entry on disk rather than each being sent a copy,
+    #a grid that is only in memory is stored in a temporary entry first
+    labels = labelGrid['label'].data
+    temporary = None
+    if isinstance(labels, np.memmap) and (Path(labels.filename).parent / 'meta.json').exists():
+        entry = Path(labels.filename).parent
+    else:
+        temporary = tempfile.mkdtemp(prefix='basin_raster')
+        entry = Path(temporary) / 'labels'
+        saveLabelGridEntry(entry, labelGrid)
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=workerLabelGrid, initargs=(entry,)) as executor:
+            list(executor.map(partial(writeWorkerGeotiff, entry=entry, tileSize=tileSize), tasks))
+    finally:
+        if temporary:
+            shutil.rmtree(temporary, ignore_errors=True)
@@ -21,62 +21,47 @@ forecastDate = datetime.strptime(forecastStartDate + '-01', "%Y-%m-%d")
 hydroSOS_input_directory = args.input_directory
 hydroSOS_output_directory = args.output_directory
 
-#HydroSOS status bands json export
-
-hydroSOSstatusBandsList = {1:[],2:[],3:[],4:[],5:[],6:[],7:[],8:[],9:[],10:[],11:[],12:[]}
-
-for file in os.listdir(hydroSOS_input_directory + '/status/statusBands/'):
-    if file.endswith('.csv'):
-        with open(hydroSOS_input_directory+'/status/statusBands/'+file, mode="r") as fr:
-                df = pd.read_csv(fr, index_col=False)
+#read every station's csv in a directory into one dataframe with a stationID column, the station id is the start of the filename
+#a directory without any csvs gives an empty dataframe of columns, so each json is written as an empty list as before
+def readStationFiles(directory, columns, **kwargs):
+    stationDFs = []
+    for file in sorted(os.listdir(directory)):
+        if file.endswith('.csv'):
+            with open(directory+file, mode="r") as fr:
+                df = pd.read_csv(fr, index_col=False, **kwargs)
                 df['stationID'] = file.split('_')[0]
-                for row in df.iterrows():
-                    hydroSOSstatusBandsList[row[1]['month']].append({
-                        'stationID':row[1]['stationID'], 
-                        'min':row[1]['min'], \
-                        'mean':row[1]['mean'], \
-                        'max':row[1]['max'], \
-                        '10%':row[1]['10%'], \
-                        '25%':row[1]['25%'], \
-                        '75%':row[1]['75%'], \
-                        '90%':row[1]['90%']
-                    })
+                stationDFs.append(df)
+    if not stationDFs:
+        return pd.DataFrame({column: pd.Series(dtype='datetime64[ns]' if column in kwargs.get('parse_dates', []) else object)
+                             for column in columns + ['stationID']})
+    return pd.concat(stationDFs, ignore_index=True)
 
-for month1 in hydroSOSstatusBandsList:
-         with open(hydroSOS_output_directory+ '/status/statusBands/'+ str(month1) +'.json','w') as fw1:
-            fw1.seek(0)
-            json.dump(hydroSOSstatusBandsList[month1],fw1)
+#write each group's records as a json list, records are built column-wise from the grouped frame rather than row by row
+#stations are listed in filename order, keys without any records get an empty list
+def writeGroupedJson(df, by, keys, columns, paths):
+    groups = {key: records[columns].to_dict('records') for key, records in df.groupby(by)}
+    for key, path in zip(keys, paths):
+        with open(path,'w') as fw:
+            json.dump(groups.get(key, []),fw)
 
-#HydroSOS status json export
-hydroSOS_input_directory = args.input_directory
-hydroSOS_statusMonthsList = {}
-for x in range (1, 7):
-    hydroSOS_statusMonthsList[(forecastDate + relativedelta(months=-x)).strftime("%Y%m")] = [] 
+#HydroSOS status bands json export, one file per month of the year
+Path(hydroSOS_output_directory + '/status/statusBands/').mkdir(parents=True, exist_ok=True)
+statusBands = readStationFiles(hydroSOS_input_directory + '/status/statusBands/', ['month','min','mean','max','10%','25%','75%','90%'])
+months = list(range(1, 13))
+writeGroupedJson(statusBands, 'month', months, ['stationID','min','mean','max','10%','25%','75%','90%'],
+                 [hydroSOS_output_directory+ '/status/statusBands/'+ str(month1) +'.json' for month1 in months])
 
+#HydroSOS status json export
 # six months status data for HydroSOS 
+hydroSOS_statusMonths = [(forecastDate + relativedelta(months=-x)).strftime("%Y%m") for x in range(1, 7)]
 hydroSOS_statusStartDate = forecastDate + relativedelta(months=-6)
-hydroSOS_date = forecastStartDate.replace('-','')
-
-for file in os.listdir(hydroSOS_input_directory + '/status/status/'):
-    if file.endswith('.csv'):
-        with open(hydroSOS_input_directory+'/status/status/'+file, mode="r") as fr:
-                df = pd.read_csv(fr, index_col=False, parse_dates=['date'])
-                df = df[df['date']>hydroSOS_statusStartDate]
-                df['year'] = df['date'].dt.year.astype(float)
-                df['month'] = df['date'].dt.month.astype(float)
-                df['year'] = df['date'].dt.year.astype(int)
-                df['month'] = df['date'].dt.month.astype(int)
-                df['month'] = df['month'].apply(lambda x: '{0:0>2}'.format(x))
-                df['date'] = df['year'].astype(str) + '-' + df['month'].astype(str)
-                df = df.groupby(['year','month'], as_index=False)['Discharge'].mean()
-                df['stationID'] = file.split('_')[0]
-                for row in df.iterrows():
-                    hydroSOS_statusMonthsList[str(row[1]['year'])+''+str(row[1]['month'])].append({
-                    'stationID':row[1]['stationID'], 
-                    'value':row[1]['Discharge']})
 
-for month6 in hydroSOS_statusMonthsList:
-        with open(hydroSOS_output_directory +'/status/status/'+ str(month6) +'_status.json','w') as fw6:
-            fw6.seek(0)
-            json.dump(hydroSOS_statusMonthsList[month6],fw6)
-        
\ No newline at end of file
+Path(hydroSOS_output_directory + '/status/status/').mkdir(parents=True, exist_ok=True)
+status = readStationFiles(hydroSOS_input_directory + '/status/status/', ['date','Discharge'], parse_dates=['date'])
+status = status[status['date']>hydroSOS_statusStartDate]
+status = status.assign(statusMonth=status['date'].dt.strftime("%Y%m"))
+#months after the forecast start aren't exported
+status = status[status['statusMonth'].isin(hydroSOS_statusMonths)]
+status = status.groupby(['statusMonth','stationID'], as_index=False, sort=False)['Discharge'].mean().rename(columns={'Discharge':'value'})
+writeGroupedJson(status, 'statusMonth', hydroSOS_statusMonths, ['stationID','value'],
+                 [hydroSOS_output_directory +'/status/status/'+ str(month6) +'_status.json' for month6 in hydroSOS_statusMonths])
@@ -0,0 +1,82 @@
+"""
+Persistent ingest cache for csv timeseries, used by status/statuscalc.py and forecast/forecastcalc.py (--cacheDirectory).
+
+The first time a csv is read its parsed columns are stored as .npy arrays in the cache directory, later runs memory map those
+arrays instead of re-parsing the csv. Entries are keyed by the file's path and the parser settings and are used while the file's
+size and modification time are unchanged. If rows have only been appended to the file since it was cached, only the new rows
+are parsed and added to the entry, anything else causes the whole file to be parsed again.
+
+The cache directory can be deleted at any time, it is rebuilt on the next run.
+"""
+
+import hashlib
+import io
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+def entryDirectory(cacheDirectory, path, key):
+    """
+    The cache entry for a file and parser settings.
+    """
+    return Path(cacheDirectory) / hashlib.sha1(f"{os.path.abspath(path)}|{key}".encode()).hexdigest()
+
+def loadEntry(entry, meta):
+    """
+    Reads a cached dataframe back from its memory mapped column arrays.
+    The columns are the read only memory maps rather than copies, so values must be copied before being modified in place.
+    """
+    return pd.DataFrame({column: np.load(entry / f"{i}.npy", mmap_mode='r') for i, column in enumerate(meta['columns'])}, copy=False)
+
+def saveEntry(entry, df, data, mtime):
+    """
+    Stores df as one .npy per column along with what is needed to validate it later.
+    Dataframes with text columns aren't cached as they can't be memory mapped.
+    """
+    if not all(pd.api.types.is_numeric_dtype(df[c]) or pd.api.types.is_datetime64_dtype(df[c]) for c in df.columns):
+        return
+    #rows can only be appended after a complete line
+    parsedBytes = len(data) if data.endswith(b'\n') else 0
+    meta = {'columns': [str(c) for c in df.columns], 'size': len(data), 'mtime': mtime,
+            'parsedBytes': parsedBytes, 'prefixHash': hashlib.sha256(data[:parsedBytes]).hexdigest()}
+    #write to a temporary directory and swap it in, so a reader never sees a half written entry
+    temporary = entry.with_name(f"{entry.name}.{os.getpid()}.tmp")
+    temporary.mkdir(parents=True, exist_ok=True)
+    for i, column in enumerate(df.columns):
+        np.save(temporary / f"{i}.npy", df[column].to_numpy(), allow_pickle=False)
+    with open(temporary / 'meta.json', 'w') as fw:
+        json.dump(meta, fw)
+    shutil.rmtree(entry, ignore_errors=True)
+    os.replace(temporary, entry)
+
+def readCached(path, parse, cacheDirectory, key=''):
+    """
+    Returns parse(path), served from the cache in cacheDirectory if the file hasn't changed since it was cached.
+    parse must accept a path or file object and return a dataframe, key must identify any settings that change what parse returns.
+    """
+    entry = entryDirectory(cacheDirectory, path, key)
+    mtime = os.stat(path).st_mtime_ns
+    meta = None
+    if (entry / 'meta.json').exists():
+        with open(entry / 'meta.json', 'r') as fr:
+            meta = json.load(fr)
+        if meta['size'] == os.path.getsize(path) and meta['mtime'] == mtime:
+            return loadEntry(entry, meta)
+
+    with open(path, 'rb') as fr:
+        data = fr.read()
+    df = None
+    if meta and 0 < meta['parsedBytes'] < len(data) and hashlib.sha256(data[:meta['parsedBytes']]).hexdigest() == meta['prefixHash']:
+        #only rows have been appended, parse them under the original header
+        header = data[:data.index(b'\n') + 1]
+        tail = parse(io.BytesIO(header + data[meta['parsedBytes']:]))
+        if [str(c) for c in tail.columns] == meta['columns']:
+            df = pd.concat([loadEntry(entry, meta), tail], ignore_index=True)
+    if df is None:
+        df = parse(io.BytesIO(data))
+    saveEntry(entry, df, data, mtime)
+    return df
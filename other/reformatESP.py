@@ -1,6 +1,8 @@
 """
 This script takes the combined output from ESP and reformats it into separate status (obsDir) and forecast (forecastDir) directories.
 For forecasts, it also separates out individual ENS members into their own files. This means the output can directly be parsed by StatusCalc and ForecastCalc.
+
+forecastcalc.py can also read the combined files directly with --inputFormat esp, using splitESP below, so they don't need reformatting first.
 """
 
 import pandas as pd
@@ -9,59 +11,84 @@ import os
 from pathlib import Path
 from datetime import date
 
-parser = argparse.ArgumentParser(
-                    prog='reformatESP',
-                    description='Reformats ESP data so it can be run by the HydroSOS processing scripts',
-                    epilog='Ezra K, UKCEH, 15082024')
+#the part of a combined ESP filename that holds its forecast date, input files are at yyyym if the forecast month < 10 else yyyymm
+def espFilenamePart(forecast_date):
+    forecastMonth = forecast_date.split('-')[1]
+    forecastYear = forecast_date.split('-')[0]
+    if int(forecastMonth) < 10:
+        return f"{forecastYear}{int(forecastMonth)}"
+    return f"{forecastYear}{forecastMonth}"
 
-parser.add_argument('forecast_date', help='forecast date, forecast date, should contain the date of the ESP forecast of interest, as YYYY-MM.')        
-parser.add_argument('input_directory', help='input directory, should ONLY contain combined ESP model run data, see GitHub for examples.')        
-parser.add_argument('output_directory', help='output directory, where files will be outputted to.')
+#map each catchment id to its combined ESP .csv in input_directory, only files for forecast_date (YYYY-MM) if it is set
+#raises a ValueError if a catchment has more than one file, e.g. files for several forecast dates without forecast_date
+def espCatchmentFiles(input_directory, forecast_date=None):
+    filenamePart = espFilenamePart(forecast_date) if forecast_date else None
+    catchmentFiles = {}
+    for f in sorted(os.listdir(input_directory)):
+        #check the file is a .csv, for the right year
+        if f.endswith('.csv') and (filenamePart is None or f.split('_')[2] == filenamePart):
+            catchment = f.split('_')[0]
+            if catchment in catchmentFiles:
+                raise ValueError(f"{catchmentFiles[catchment]} and {f} are both combined ESP files for catchment {catchment}")
+            catchmentFiles[catchment] = f
+    return catchmentFiles
 
-args = parser.parse_args()
+#split a combined ESP dataframe into its obssim data (Date, varName) and the monthly means of its ENS members (year, month, Date, ENS...)
+#the members are averaged by month in one groupby for all of them (forecasts should be daily)
+def splitESP(data, varName='Discharge'):
+    #rename date
+    data = data.rename(columns={'DATE':'Date'})
+    # filter the data to just obsSim
+    status = data.filter(['Date','obsSim'])
+    status = status[status['obsSim'].notnull()]
+    status = status.rename(columns={'obsSim':varName})
+    # filter the data to just ENS members, and average by month
+    data = data[data['obsSim'].isnull()].copy()
+    data['Date'] = pd.to_datetime(data['Date'])
+    data['year'] = data['Date'].dt.year.astype(int)
+    data['month'] = data['Date'].dt.month.astype(int)
+    data = data.groupby(['year','month']).mean(numeric_only=True)
+    data.reset_index(inplace=True)
+    data['Date'] = pd.to_datetime({'year':data['year'], 'month':data['month'], 'day':1})
+    return status, data
 
-forecast_date = args.forecast_date
-forecastMonth = forecast_date.split('-')[1]
-forecastYear = forecast_date.split('-')[0]
+if __name__ == "__main__":
 
-if int(forecastMonth) < 10:
-    filenamePart = f"{forecastYear}{int(forecastMonth)}" # if forecast month < 10, input files are at yyyym else yyyymm
-else:
-    filenamePart = f"{forecastYear}{forecastMonth}"
+    parser = argparse.ArgumentParser(
+                        prog='reformatESP',
+                        description='Reformats ESP data so it can be run by the HydroSOS processing scripts',
+                        epilog='Ezra K, UKCEH, 15082024')
 
-#make output subdirectories
-Path(f"{args.output_directory}/forecastDir").mkdir(parents=True, exist_ok=True)
-Path(f"{args.output_directory}/obsDir").mkdir(parents=True, exist_ok=True)
+    parser.add_argument('forecast_date', help='forecast date, forecast date, should contain the date of the ESP forecast of interest, as YYYY-MM.')        
+    parser.add_argument('input_directory', help='input directory, should ONLY contain combined ESP model run data, see GitHub for examples.')        
+    parser.add_argument('output_directory', help='output directory, where files will be outputted to.')
+    parser.add_argument('--outputFormat', help='csv (default) or parquet, parquet writes obsDir (Date, Discharge) and forecastDir (Date, ENS, Discharge) as datasets partitioned by stationID instead of one csv per catchment and ensemble member')
 
-#list the files
-files = os.listdir(args.input_directory)
-for f in files:
-    #check the file is a .csv
-    if f.endswith('.csv'):
-        #check the file is the right year
-        if f.split('_')[2] == filenamePart:
-            id = f.split('_')[0]
-            data = pd.read_csv(f"{args.input_directory}/{f}")
-            #rename date
-            data.rename(columns={'DATE':'Date'}, inplace=True)
-            # filter the data to just obsSim and write to obsDir
-            status = data.filter(['Date','obsSim'])
-            status = status[status['obsSim'].notnull()]
-            status.rename(columns={'obsSim':'Discharge'}, inplace=True)
-            status.to_csv(f"{args.output_directory}/obsDir/ESP_{id}.csv", index=False)
-            # filter the data to just ENS members, and average by month (forecasts should be daily)
-            data = data[data['obsSim'].isnull()]
-            data['Date'] = pd.to_datetime(data['Date'])
-            data['year'] = data['Date'].dt.year.astype(int)
-            data['month'] = data['Date'].dt.month.astype(int)
-            data = data.groupby(['year','month']).mean(numeric_only=True)
-            data.reset_index(inplace=True)
-            data['Date'] = pd.to_datetime({'year':data['year'], 'month':data['month'], 'day':1})
-            #for the hydrosos script, the obs data needs to start in january 
-            for col in data.columns:
-                if 'ENS' in col:
-                    forecast = data.filter(['Date',col])
-                    forecast.rename(columns={col:'Discharge'}, inplace=True)
-                    forecast.to_csv(f"{args.output_directory}/forecastDir/ESP_{col}_{id}.csv", index=False)
+    args = parser.parse_args()
+    outputFormat = args.outputFormat if args.outputFormat else 'csv'
 
-            
+    #make output subdirectories
+    Path(f"{args.output_directory}/forecastDir").mkdir(parents=True, exist_ok=True)
+    Path(f"{args.output_directory}/obsDir").mkdir(parents=True, exist_ok=True)
+
+    for id, f in espCatchmentFiles(args.input_directory, args.forecast_date).items():
+        status, data = splitESP(pd.read_csv(f"{args.input_directory}/{f}"))
+        # write the obsSim data to obsDir
+        if outputFormat == 'parquet':
+            Path(f"{args.output_directory}/obsDir/stationID={id}").mkdir(parents=True, exist_ok=True)
+            status.assign(Date=pd.to_datetime(status['Date'])).to_parquet(f"{args.output_directory}/obsDir/stationID={id}/part-0.parquet", index=False)
+        else:
+            status.to_csv(f"{args.output_directory}/obsDir/ESP_{id}.csv", index=False)
+        #for the hydrosos script, the obs data needs to start in january 
+        if outputFormat == 'parquet':
+            #one long Date, ENS, Discharge table per catchment rather than a file per member
+            ens_columns = [col for col in data.columns if 'ENS' in col]
+            forecast = data.melt(id_vars=['Date'], value_vars=ens_columns, var_name='ENS', value_name='Discharge')
+            Path(f"{args.output_directory}/forecastDir/stationID={id}").mkdir(parents=True, exist_ok=True)
+            forecast.to_parquet(f"{args.output_directory}/forecastDir/stationID={id}/part-0.parquet", index=False)
+            continue
+        for col in data.columns:
+            if 'ENS' in col:
+                forecast = data.filter(['Date',col])
+                forecast.rename(columns={col:'Discharge'}, inplace=True)
+                forecast.to_csv(f"{args.output_directory}/forecastDir/ESP_{col}_{id}.csv", index=False)
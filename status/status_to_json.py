@@ -2,38 +2,51 @@
 import pandas as pd, os, argparse
 from pathlib import Path
 
-parser = argparse.ArgumentParser(
-                    prog='Hydro SOS csv_to_json PYTHON',
-                    description='Convert categorgised station (point data) monthly status.csv to a single monthly json file.',
-                    epilog='Gemma N, Ezra K, UKCEH, 22052024')
-
-
-parser.add_argument('input_directory', help='input directory, should ONLY contain .csv monthly categorised status (point data) files, see GitHub for examples.')   
-parser.add_argument('output_directory', help='directory files will be saved to as {date}.json')     
-
-args = parser.parse_args()
-
-allFilesDF = pd.DataFrame()
-# read the CSV files in the data directory
-for index, filename in enumerate(os.listdir(args.input_directory)):
-        if filename.endswith('.csv'):
-            with open(args.input_directory+'/'+filename, mode="r") as fr:
-                df = pd.read_csv(fr)
-                filename = os.path.splitext(str(filename))[0] #remove file extenstion
-                stationID = filename.split('_')[1] #remove cat_
-                df['stationID'] = stationID
-                allFilesDF = pd.concat([allFilesDF,df])
-
-allFilesDF['date'] = pd.to_datetime(allFilesDF['date'])
-allFilesDF = allFilesDF.sort_values(by='date', ascending=True)
-allFilesDF.drop_duplicates(inplace=True)
-allFilesDF.set_index(['date'], inplace=True)
-allFilesDF['category'] = allFilesDF['category'].astype('Int64')
-
-Path(args.output_directory).mkdir(parents=True, exist_ok=True)
-for date in allFilesDF.index:
-    #this happens if there is only one record
-    if type(allFilesDF.loc[date]) == pd.core.series.Series:
-        pd.DataFrame(allFilesDF.loc[date]).T.to_json(f"{args.output_directory}/{date.strftime('%Y-%m')}.json", orient = 'records')
-    else: 
-        allFilesDF.loc[date].to_json(f"{args.output_directory}/{date.strftime('%Y-%m')}.json", orient = 'records')
\ No newline at end of file
+def readStatusFiles(input_directory):
+    """
+    Reads every cat_{stationID}.csv in input_directory into one date, category, stationID dataframe.
+    """
+    stationDFs = []
+    # read the CSV files in the data directory
+    for filename in sorted(os.listdir(input_directory)):
+            if filename.endswith('.csv'):
+                with open(input_directory+'/'+filename, mode="r") as fr:
+                    df = pd.read_csv(fr)
+                    filename = os.path.splitext(str(filename))[0] #remove file extenstion
+                    stationID = filename.split('_')[1] #remove cat_
+                    df['stationID'] = stationID
+                    stationDFs.append(df)
+    #concatenate once, rather than copying the growing dataframe for every file
+    if not stationDFs:
+        return pd.DataFrame()
+    return pd.concat(stationDFs)
+
+def writeStatusJson(allFilesDF, output_directory):
+    """
+    Writes one {YYYY-MM}.json file per month listing the category of every station, from a date, category, stationID dataframe
+    such as readStatusFiles or statuscalc.calculateStatusBatch return.
+    Each file is written once from its month's group of records, stations are listed in the order they appear in allFilesDF.
+    """
+    allFilesDF = allFilesDF.copy()
+    allFilesDF['date'] = pd.to_datetime(allFilesDF['date'])
+    allFilesDF.drop_duplicates(inplace=True)
+    allFilesDF['category'] = allFilesDF['category'].astype('Int64')
+
+    Path(output_directory).mkdir(parents=True, exist_ok=True)
+    for date, records in allFilesDF.groupby('date', sort=True):
+        records.drop(columns='date').to_json(f"{output_directory}/{date.strftime('%Y-%m')}.json", orient = 'records')
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+                        prog='Hydro SOS csv_to_json PYTHON',
+                        description='Convert categorgised station (point data) monthly status.csv to a single monthly json file.',
+                        epilog='Gemma N, Ezra K, UKCEH, 22052024')
+
+
+    parser.add_argument('input_directory', help='input directory, should ONLY contain .csv monthly categorised status (point data) files, see GitHub for examples.')
+    parser.add_argument('output_directory', help='directory files will be saved to as {date}.json')
+
+    args = parser.parse_args()
+
+    writeStatusJson(readStatusFiles(args.input_directory), args.output_directory)
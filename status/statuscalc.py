@@ -7,205 +7,614 @@ import argparse
 import pandas as pd
 import numpy as np
 import os
+import io
+import json
+import hashlib
+import warnings
+from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor
+import sys
+from functools import partial
 from pathlib import Path
-
-parser = argparse.ArgumentParser(
-                    prog='StatusCalc v3 PYTHON',
-                    description='Calculates status based on daily timeseries for the HydroSOS portal',
-                    epilog='Katie F-C, Ezra K, UKCEH, 14052024')
-
-
-parser.add_argument('input_directory', help='input directory, should ONLY contain .csv daily timeseries, see GitHub for examples.')        
-parser.add_argument('output_directory', help='directory files will be saved to as cat_{input_file}.csv')  
-parser.add_argument('--dateFormat', help='format of the dates in the input directory (default %d/%m/%Y)')
-parser.add_argument('--startYear', help='start of the year range that will be used to calculate the reference average.')
-parser.add_argument('--endYear', help='end of the year range that will be used to calculate the reference average.')
-parser.add_argument('--outputLength', help='how many years of data to output (default 5)')
-parser.add_argument('--debugging', help='print debugging')
-
-args = parser.parse_args()
-
-if args.startYear:
-    stdStart=int(args.startYear)
-else: 
-    print("No start year set, defaulting to 1991.")
-    stdStart=1991
-
-if args.endYear:
-    stdEnd=int(args.endYear)
-else: 
-    print("No end year set, defaulting to 2020.")
-    stdEnd=2020
-
-if args.dateFormat:
-    dateFormat=args.dateFormat
-else: 
-    print("No date format set, defaulting to %d/%m/%Y.")
-    dateFormat="%d/%m/%Y"
-
-if args.outputLength:
-    outputLength = int(args.outputLength)
-else:
-    print("No output length set, defaulting to 5 years.")
-    outputLength = 5
-
-
-assert stdStart < stdEnd, "startYear must be greater than endYear"
-
-#stationid="39001"
-#input_directory="./example_data/input/"
-#output_directory="./example_data/output_Python/"
-
-if not args.input_directory.endswith(os.sep):
-    args.input_directory = args.input_directory + os.sep
- 
-if not args.output_directory.endswith(os.sep):
-    args.output_directory = args.output_directory + os.sep
- 
-Path(args.output_directory).mkdir(parents=True, exist_ok=True)
-Path(f"{args.output_directory}/statusBands").mkdir(parents=True, exist_ok=True)
-
-for f in os.listdir(args.input_directory):
-
-    if f.endswith('.csv'):
-        print(f)
-        flowdata = pd.read_csv(f"{args.input_directory}{f}")
-        flowdata.columns = ['date','flow']
-        flowdata['date'] = pd.to_datetime(flowdata['date'], format=dateFormat)
-
-        #check dates are sequential
-        diff = pd.date_range(start = flowdata['date'].min(), end = flowdata['date'].max() ).difference(flowdata['date'])
-        if len(diff) > 0:
-            flowdata.set_index('date', inplace=True)
-            for md in diff: 
-                flowdata.loc[md,'flow'] = pd.NA
-            flowdata.reset_index(inplace=True)
-
-        #month and year column
-        flowdata['month'] = flowdata['date'].dt.month
-        flowdata['year'] = flowdata['date'].dt.year
-
-        #check whether or not there is enough data? 
-        print(f"There are {flowdata['year'].max() - flowdata['year'].min()} years of data in this file.")
-        print(f"There are {sum(flowdata['flow'].isnull())} missing data points, which is {np.round(sum(flowdata['flow'].isnull())/len(flowdata) * 100,4)}% of the total data")
-
-        """ STEP 1: CALCULATE MEAN MONTHLY FLOWS """
-
-        #calculate percentage completeness for each year/month
-        groupBy = (flowdata.groupby(['month','year']).count()['flow']/flowdata.groupby(['month','year']).count()['date']) * 100
-        groupBy = pd.DataFrame(groupBy)
-        groupBy.rename(columns={0:'monthly%'}, inplace=True)
-        #calculate mean flows for each year/month
-        groupBy['mean_flow'] = flowdata.groupby(['month','year'])['flow'].mean()
-        #set the mean flow to NAN if there is less than 50 % data
-        groupBy.loc[groupBy['monthly%'] < 50,'mean_flow'] = pd.NA
-        groupBy.reset_index(inplace=True)
-
-        """ STEP 2: CALCULATE MEAN MONTHLY FLOWS AS A PERCENTAGE OF AVERAGE REFERENCE PERIOD """
-
-        #calculate long term average
-        LTA = groupBy[(groupBy['year'] >= stdStart) & (groupBy['year'] <= stdEnd)].groupby(['month'])['mean_flow'].mean()
-
-        #divide each month by this long term average
-        skip_file = False
-        for i in range(1,13):
-            if i not in LTA.index:
-                print("ERROR: Month %i missing in Long Term Average for file %s. Skipping file" % (i,f))
-                skip_file = True
-                break
-            groupBy.loc[groupBy['month'] == i,'percentile_flow'] = groupBy['mean_flow'][groupBy['month'] == i]/LTA[i] * 100
-
-        if skip_file:
+from status_to_json import writeStatusJson
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'other'))
+from ingest_cache import readCached
+
+#target weibull ranks for the category thresholds, and the column order of the statusBands output
+TARGET_RANKS = [0.1, 0.25, 0.75, 0.9]
+BAND_COLUMNS = TARGET_RANKS + ['max', 'median', 'min']
+#stations held in memory at once by --panel
+PANEL_BLOCK = 1000
+
+def weibullRanks(values):
+    """
+    Weibull rank (rank/(count+1)) along the last axis of an array, ties get their average rank and na values stay na.
+    Works on a single (month x year) matrix or a stack of them, e.g. (station x month x year).
+    """
+    values = np.asarray(values, dtype=float)
+    valid = ~np.isnan(values)
+    #count how many values are below / not above each value, na never compares true
+    below = (values[..., None, :] < values[..., :, None]).sum(axis=-1)
+    notAbove = (values[..., None, :] <= values[..., :, None]).sum(axis=-1)
+    ranks = (below + notAbove + 1) / 2
+    count = valid.sum(axis=-1, keepdims=True)
+    return np.where(valid, ranks / (count + 1), np.nan)
+
+def calculateThresholds(percentiles):
+    """
+    Calculates the status thresholds from a (month x year) matrix of mean flows as a percentage of the long term average.
+    Stacks of matrices, e.g. (station x month x year), are processed in one go.
+    Returns an array with the last axis ordered as BAND_COLUMNS: the 10/25/75/90 thresholds, then max, median and min.
+    """
+    percentiles = np.asarray(percentiles, dtype=float)
+    targets = np.array(TARGET_RANKS)
+    shape = percentiles.shape[:-1] + (len(targets), percentiles.shape[-1])
+    ranks = np.broadcast_to(weibullRanks(percentiles)[..., None, :], shape)
+    values = np.broadcast_to(percentiles[..., None, :], shape)
+    #find the closest rank to the target ranks above and below, the first match is used if ranks are tied
+    lowerRanks = np.where(ranks <= targets[:, None], ranks, -np.inf)
+    higherRanks = np.where(ranks >= targets[:, None], ranks, np.inf)
+    lowerIdx = lowerRanks.argmax(axis=-1)[..., None]
+    higherIdx = higherRanks.argmin(axis=-1)[..., None]
+    closestLower = np.take_along_axis(lowerRanks, lowerIdx, axis=-1)[..., 0]
+    closestHigher = np.take_along_axis(higherRanks, higherIdx, axis=-1)[..., 0]
+    #find the percentile values matching to the closest rank
+    lowerPercentile = np.take_along_axis(values, lowerIdx, axis=-1)[..., 0]
+    higherPercentile = np.take_along_axis(values, higherIdx, axis=-1)[..., 0]
+    foundLower = np.isfinite(closestLower)
+    foundHigher = np.isfinite(closestHigher)
+    #linearly interpolate the percentile value from the closest higher and lower
+    with np.errstate(invalid='ignore', divide='ignore'):
+        interpolated = lowerPercentile + ((targets - closestLower) / (closestHigher - closestLower)) * (higherPercentile - lowerPercentile)
+    # if the target rank perfectly matches an observed rank, or no observed ranks were higher, use the lower percentile
+    # if no observed ranks were lower, use the higher percentile
+    thresholds = np.select([foundLower & foundHigher & (lowerPercentile != higherPercentile), foundLower, foundHigher],
+                           [interpolated, lowerPercentile, higherPercentile], np.nan)
+    #add max, median and min
+    stats = np.stack([np.nanmax(percentiles, axis=-1), np.nanmedian(percentiles, axis=-1), np.nanmin(percentiles, axis=-1)], axis=-1)
+    return np.concatenate([thresholds, stats], axis=-1)
+
+def assignCategories(percentiles, months, thresholds):
+    """
+    Assigns a status category (1 low flow to 5 high flow) to each percentage of average flow using the thresholds for its month.
+    months run 1-12 and thresholds is the (month x band) array from calculateThresholds, leading station axes are allowed on all three.
+    Returns a float array, na where the flow or the thresholds for that month are missing.
+    """
+    percentiles = np.asarray(percentiles, dtype=float)
+    monthIdx = np.asarray(months, dtype=int)[..., None] - 1
+    edges = np.take_along_axis(np.asarray(thresholds, dtype=float)[..., :len(TARGET_RANKS)], monthIdx, axis=-2)
+    # a flow equal to a threshold falls in the lower category, so count the thresholds strictly below it
+    categories = (percentiles[..., None] > edges).sum(axis=-1) + 1
+    return np.where(np.isnan(percentiles) | np.isnan(edges).any(axis=-1), np.nan, categories)
+
+def prepareFlowData(flowdata, dateFormat=None):
+    """
+    Prepares a daily timeseries (dates in the first column, flows in the second) as a date, flow, month, year dataframe.
+    Missing days are added with na flow, dateFormat is only needed if the dates are still strings.
+    """
+    flowdata = flowdata.iloc[:, :2].copy()
+    flowdata.columns = ['date','flow']
+    flowdata['date'] = pd.to_datetime(flowdata['date'], format=dateFormat)
+
+    #check dates are sequential, missing days are added in one go after the existing rows
+    diff = pd.date_range(start = flowdata['date'].min(), end = flowdata['date'].max() ).difference(flowdata['date'])
+    if len(diff) > 0:
+        flowdata = pd.concat([flowdata, pd.DataFrame({'date': diff, 'flow': np.nan})], ignore_index=True)
+
+    #month and year column
+    flowdata['month'] = flowdata['date'].dt.month
+    flowdata['year'] = flowdata['date'].dt.year
+    return flowdata
+
+def parseFlowCsv(f, dateFormat):
+    """
+    Reads the date and flow columns of a daily timeseries csv, with the dates parsed.
+    """
+    flowdata = pd.read_csv(f).iloc[:, :2].copy()
+    flowdata[flowdata.columns[0]] = pd.to_datetime(flowdata.iloc[:, 0], format=dateFormat)
+    return flowdata
+
+def readFlowFile(path, dateFormat=None, cacheDirectory=None):
+    """
+    Reads a daily timeseries csv, or one station's partition of a parquet dataset.
+    If cacheDirectory is set csvs are parsed through the ingest cache, so unchanged files aren't parsed again.
+    """
+    if os.path.isdir(path) or path.endswith('.parquet'):
+        return pd.read_parquet(path)
+    if cacheDirectory:
+        return readCached(path, partial(parseFlowCsv, dateFormat=dateFormat), cacheDirectory, key=f"statuscalc {dateFormat}")
+    return pd.read_csv(path)
+
+def readFlowData(path, dateFormat, cacheDirectory=None):
+    """
+    Reads a daily timeseries csv, or one station's partition of a parquet dataset, see prepareFlowData.
+    """
+    return prepareFlowData(readFlowFile(path, dateFormat, cacheDirectory), dateFormat)
+
+def stationName(f):
+    """
+    Station id from an input filename (12001.csv) or parquet dataset partition (stationID=12001).
+    """
+    return f.split('=')[-1].split('.')[0]
+
+def categoriesPath(output_directory, stationID, outputFormat):
+    """
+    Where the categories for a station are written, cat_{id}.csv or the station's partition of the categories parquet dataset.
+    """
+    if outputFormat == 'parquet':
+        return f"{output_directory}categories/stationID={stationID}/part-0.parquet"
+    return f"{output_directory}cat_{stationID}.csv"
+
+def writeCategories(categories, output_directory, stationID, outputFormat):
+    """
+    Writes a station's date, category dataframe as csv or as a partition of the categories parquet dataset (with datetime dates).
+    """
+    path = categoriesPath(output_directory, stationID, outputFormat)
+    if outputFormat == 'parquet':
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        categories.assign(date=pd.to_datetime(categories['date'])).to_parquet(path, index=False)
+    else:
+        categories.to_csv(path, index=False)
+
+def readCategories(output_directory, stationID, outputFormat):
+    """
+    Reads back a station's date, category dataframe written by writeCategories, with the dates as YYYY-MM-DD strings.
+    """
+    path = categoriesPath(output_directory, stationID, outputFormat)
+    if outputFormat == 'parquet':
+        categories = pd.read_parquet(path)
+        categories['date'] = categories['date'].dt.strftime('%Y-%m-%d')
+        return categories
+    return pd.read_csv(path)
+
+def monthlyFlows(flowdata):
+    """
+    Calculates the percentage completeness and mean flow for each month/year, the mean is na if less than 50% of the days have data.
+    """
+    #count the days with data, all days and mean flow for each year/month in one pass
+    stats = flowdata.groupby(['month','year'])['flow'].agg(['count','size','mean'])
+    #calculate percentage completeness for each year/month
+    groupBy = pd.DataFrame({'monthly%': (stats['count'] / stats['size']) * 100})
+    #calculate mean flows for each year/month
+    groupBy['mean_flow'] = stats['mean']
+    #set the mean flow to NAN if there is less than 50 % data
+    groupBy.loc[groupBy['monthly%'] < 50,'mean_flow'] = pd.NA
+    groupBy.reset_index(inplace=True)
+    return groupBy
+
+def percentageOfAverage(groupBy, stdStart, stdEnd):
+    """
+    Adds percentile_flow to groupBy, each mean monthly flow as a percentage of the long term average for that month over the reference period.
+    Returns the long term average, raises ValueError if a month is missing from it.
+    """
+    #calculate long term average
+    LTA = groupBy[(groupBy['year'] >= stdStart) & (groupBy['year'] <= stdEnd)].groupby(['month'])['mean_flow'].mean()
+
+    #divide each month by this long term average
+    for i in range(1,13):
+        if i not in LTA.index:
+            raise ValueError("Month %i missing in Long Term Average" % i)
+        groupBy.loc[groupBy['month'] == i,'percentile_flow'] = groupBy['mean_flow'][groupBy['month'] == i]/LTA[i] * 100
+    return LTA
+
+def calculateStatusBands(groupBy, stdStart, stdEnd, debugging=False):
+    """
+    Calculates the status bands (month x BAND_COLUMNS) from the reference period percentages of average.
+    """
+    refBy = groupBy[(groupBy['year'] >= stdStart) & (groupBy['year'] <= stdEnd)]
+
+    # one row per month, one column per reference year, na values automatically set as rank na
+    percentileMatrix = refBy.pivot(index='month', columns='year', values='percentile_flow').reindex(range(1,13))
+    statusBands = pd.DataFrame(calculateThresholds(percentileMatrix.to_numpy(dtype=float)), index=range(1,13), columns=BAND_COLUMNS)
+    if debugging:
+        print(f"Percentiles in ref: \n{percentileMatrix}")
+        print(f"Thresholds: \n{statusBands}")
+    return statusBands
+
+def categoryOutput(groupBy, outputLength):
+    """
+    The date, category dataframe for the last outputLength years, as written to cat_{id}.csv.
+    """
+    groupBy = groupBy[groupBy['year'] >= (max(groupBy['year']) - outputLength)].sort_values(['year','month'])
+    categories = pd.DataFrame({'date': pd.to_datetime(groupBy[['year', 'month']].assign(DAY=1)).dt.strftime('%Y-%m-%d'),
+                               'category': groupBy['category'].astype('Int64')})
+    return categories.reset_index(drop=True)
+
+def calculateStatus(flowdata, stdStart=1991, stdEnd=2020, outputLength=5, dateFormat=None):
+    """
+    Calculates the status categories and status bands for one daily timeseries held in memory, no files are read or written.
+    flowdata is a dataframe of daily dates and flows laid out like the input csvs, dateFormat is only needed if the dates are strings.
+    Returns the date, category dataframe (as written to cat_{id}.csv) and the statusBands dataframe.
+    Raises ValueError if a month is missing from the long term average.
+    """
+    groupBy = monthlyFlows(prepareFlowData(flowdata, dateFormat))
+    percentageOfAverage(groupBy, stdStart, stdEnd)
+    statusBands = calculateStatusBands(groupBy, stdStart, stdEnd)
+    groupBy['category'] = assignCategories(groupBy['percentile_flow'].to_numpy(dtype=float), groupBy['month'].to_numpy(), statusBands.to_numpy())
+    return categoryOutput(groupBy, outputLength), statusBands
+
+def calculateStatusBatch(stations, stdStart=1991, stdEnd=2020, outputLength=5, dateFormat=None):
+    """
+    Runs calculateStatus for a dict of {stationID: daily dataframe}.
+    Returns the categories of every station as one date, category, stationID dataframe, ready for status_to_json.writeStatusJson,
+    a dict of {stationID: statusBands} and a dict of {stationID: reason} for the stations that were skipped.
+    """
+    categories = []
+    statusBands = {}
+    skipped = {}
+    for stationID, flowdata in stations.items():
+        try:
+            stationCategories, statusBands[stationID] = calculateStatus(flowdata, stdStart, stdEnd, outputLength, dateFormat)
+        except ValueError as e:
+            skipped[stationID] = str(e)
             continue
-
-        """ STEP 3: CALCULATE RANK PERCENTILES OF REFERENCE PERIOD """
-
-        refBy = groupBy[(groupBy['year'] >= stdStart) & (groupBy['year'] <= stdEnd)]
-
-        # na values automatically set as rank na
-        for i in range(1,13):
-            refBy.loc[refBy['month'] == i, 'weibell_rank'] = refBy.loc[refBy['month'] == i, 'percentile_flow'].rank(na_option='keep')/(refBy.loc[refBy['month'] == i, 'percentile_flow'].count()+1)
-
-        targetRanks = {0.10,0.25,0.75,0.9}
-        thresholdDict = {}
-
-        for i in range(1,13):
-            ranks = np.array(refBy.loc[refBy['month'] == i, 'weibell_rank'])
-            percentiles = np.array(refBy.loc[refBy['month'] == i, 'percentile_flow'])
-            for j in targetRanks:
-                #find the closest rank to the target ranks above and below
-                lower_vals = ranks[ranks <= j]
-                higher_vals = ranks[ranks >= j]
-                closest_higher = np.min(higher_vals) if higher_vals.size > 0 else 'NOTF'
-                closest_lower = np.max(lower_vals) if lower_vals.size > 0 else 'NOTF'
-                closest_higher_idx = np.where(ranks == closest_higher)[0][0] if closest_higher != 'NOTF' else 'NOTF'
-                closest_lower_idx = np.where(ranks == closest_lower)[0][0] if closest_lower != 'NOTF' else 'NOTF'
-                #find the percentile values matching to the closet rank
-                higher_percentile = percentiles[closest_higher_idx] if closest_higher_idx != 'NOTF' else 'NOTF'
-                lower_percentile = percentiles[closest_lower_idx] if closest_lower_idx != 'NOTF' else 'NOTF'
-                #use a linear interpolation to get the percentile value of the target rank based on these two values
-                # this occurs if the target rank perfectly matches an observed rank
-                if higher_percentile == lower_percentile:
-                    interpolated_percentile = lower_percentile
-                # this occurs if no observed ranks were higher than the target rank, in which case set as the lower percentile
-                elif higher_percentile == 'NOTF':
-                    interpolated_percentile = lower_percentile
-                # this occurs if no observed ranks were lower than the target rank, in which case set as the higher percentile
-                elif lower_percentile == 'NOTF':
-                    interpolated_percentile = higher_percentile
-                # otherwise linearly interpolate the percentile value from the closest higher and lower 
+        categories.append(stationCategories.assign(stationID=str(stationID)))
+    if categories:
+        categories = pd.concat(categories, ignore_index=True)
+    else:
+        categories = pd.DataFrame(columns=['date','category','stationID'])
+    return categories, statusBands, skipped
+
+def groupMean(values):
+    """
+    Mean over the first axis of an array ignoring na, na where there are no values.
+    Sums with the same compensated summation as pandas groupby mean, so the results match monthlyFlows and percentageOfAverage exactly.
+    """
+    total = np.zeros(values.shape[1:])
+    compensation = np.zeros(values.shape[1:])
+    count = np.zeros(values.shape[1:], dtype=int)
+    with np.errstate(invalid='ignore'):
+        for value in values:
+            valid = ~np.isnan(value)
+            y = np.where(valid, value - compensation, 0)
+            t = total + y
+            #an infinite value makes the compensation na, pandas resets it to 0
+            compensation = np.where(valid, np.nan_to_num(t - total - y, nan=0, posinf=np.inf, neginf=-np.inf), compensation)
+            total = np.where(valid, t, total)
+            count += valid
+        return np.where(count > 0, total / np.maximum(count, 1), np.nan)
+
+def buildPanel(stations, dateFormat=None):
+    """
+    Aligns a dict of {stationID: daily dataframe} (dates in the first column, flows in the second) into one (date x station) matrix.
+    Returns the daily dates, the flow matrix with na for missing days, and a matrix marking the days between each station's
+    first and last date, which are the days prepareFlowData would fill.
+    """
+    parsed = []
+    for flowdata in stations.values():
+        dates = pd.to_datetime(flowdata.iloc[:, 0], format=dateFormat).to_numpy(dtype='datetime64[D]')
+        parsed.append((dates, flowdata.iloc[:, 1].to_numpy(dtype=float)))
+    start = min(dates.min() for dates, _ in parsed)
+    dates = np.arange(start, max(dates.max() for dates, _ in parsed) + 1)
+    flows = np.full((len(dates), len(parsed)), np.nan)
+    inRecord = np.zeros((len(dates), len(parsed)), dtype=bool)
+    for i, (stationDates, stationFlows) in enumerate(parsed):
+        offset = (stationDates - start).astype(int)
+        flows[offset, i] = stationFlows
+        inRecord[offset.min():offset.max() + 1, i] = True
+    return pd.DatetimeIndex(dates), flows, inRecord
+
+def calculateStatusPanel(stations, stdStart=1991, stdEnd=2020, outputLength=5, dateFormat=None):
+    """
+    Calculates the same outputs as calculateStatusBatch, but with every station aligned in one (date x station) panel so
+    the monthly means, long term averages, ranks and categories are calculated for all stations at once.
+    The whole panel is held in memory, so very large networks should be passed in blocks.
+    """
+    keys = list(stations)
+    stationIDs = [str(stationID) for stationID in keys]
+    dates, flows, inRecord = buildPanel(stations, dateFormat)
+
+    """ STEP 1: CALCULATE MEAN MONTHLY FLOWS """
+
+    #lay the days out as (day of month x station x year x month), days outside a station's record or a month are na
+    years = np.arange(dates.year.min(), dates.year.max() + 1)
+    yearIdx = dates.year.to_numpy() - years[0]
+    monthIdx = dates.month.to_numpy() - 1
+    dayIdx = dates.day.to_numpy() - 1
+    dailyFlows = np.full((31, len(stationIDs), len(years), 12), np.nan)
+    dailyFlows[dayIdx, :, yearIdx, monthIdx] = flows
+    recordDays = np.zeros((len(stationIDs), len(years), 12), dtype=int)
+    np.add.at(recordDays, (slice(None), yearIdx, monthIdx), inRecord.T)
+    #months with no days in a station's record don't exist for that station
+    hasMonth = recordDays > 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        completeness = (~np.isnan(dailyFlows)).sum(axis=0) / recordDays * 100
+    meanFlow = groupMean(dailyFlows)
+    meanFlow[~hasMonth | (completeness < 50)] = np.nan
+
+    """ STEP 2: CALCULATE MEAN MONTHLY FLOWS AS A PERCENTAGE OF AVERAGE REFERENCE PERIOD """
+
+    reference = (years >= stdStart) & (years <= stdEnd)
+    LTA = groupMean(np.moveaxis(meanFlow[:, reference, :], 1, 0))
+    percentiles = meanFlow / LTA[:, None, :] * 100
+
+    skipped = {}
+    missingMonths = ~hasMonth[:, reference, :].any(axis=1)
+    for station in np.flatnonzero(missingMonths.any(axis=1)):
+        skipped[keys[station]] = "Month %i missing in Long Term Average" % (np.argmax(missingMonths[station]) + 1)
+
+    """ STEP 3: CALCULATE RANK PERCENTILES OF REFERENCE PERIOD """
+
+    #skipped stations have months with no reference data, which numpy warns about
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        thresholds = calculateThresholds(np.swapaxes(percentiles[:, reference, :], 1, 2))
+
+    """ STEP 4: ASSIGN STATUS CATEGORIES """
+
+    categories = assignCategories(percentiles, np.broadcast_to(np.arange(1, 13), percentiles.shape), thresholds[:, None, :, :])
+
+    """ STEP 5: COLLECT OUTPUTS """
+
+    lastYear = years[np.where(hasMonth.any(axis=2), np.arange(len(years)), -1).max(axis=1)]
+    output = hasMonth & (years[None, :, None] >= (lastYear - outputLength)[:, None, None])
+    output[missingMonths.any(axis=1)] = False
+    station, year, month = np.nonzero(output)
+    allCategories = pd.DataFrame({'date': pd.to_datetime({'year': years[year], 'month': month + 1, 'day': 1}).dt.strftime('%Y-%m-%d'),
+                                  'category': pd.array(categories[station, year, month]).astype('Int64'),
+                                  'stationID': np.array(stationIDs, dtype=object)[station]})
+    statusBands = {stationID: pd.DataFrame(thresholds[i], index=range(1,13), columns=BAND_COLUMNS)
+                   for i, stationID in enumerate(keys) if stationID not in skipped}
+    return allCategories, statusBands, skipped
+
+def dataFingerprint(flowdata):
+    """
+    sha256 of the daily dates and flows in flowdata, used to check whether stored results are still valid.
+    """
+    digest = hashlib.sha256()
+    digest.update(flowdata['date'].to_numpy(dtype='datetime64[ns]').view('int64').tobytes())
+    digest.update(flowdata['flow'].astype(float).to_numpy().tobytes())
+    return digest.hexdigest()
+
+def writeFingerprint(stationID, flowdata, output_directory, fingerprint):
+    """
+    Writes statusBands/{id}_fingerprint.json, which records the settings, reference period data and long term average the bands came from.
+    The last (possibly incomplete) month is recalculated by the next incremental run, so everything before it is fingerprinted as the history.
+    """
+    resumeDate = flowdata['date'].max().replace(day=1)
+    fingerprint['resumeDate'] = resumeDate.strftime('%Y-%m-%d')
+    fingerprint['history'] = dataFingerprint(flowdata[flowdata['date'] < resumeDate])
+    with open(f"{output_directory}statusBands/{stationID}_fingerprint.json", 'w') as fw:
+        json.dump(fingerprint, fw)
+
+def removeFingerprint(stationID, output_directory):
+    """
+    Removes statusBands/{id}_fingerprint.json, for bands written without one (--panel) so the next incremental run recalculates the station.
+    """
+    fingerprintFile = f"{output_directory}statusBands/{stationID}_fingerprint.json"
+    if os.path.exists(fingerprintFile):
+        os.remove(fingerprintFile)
+
+def updateStation(stationID, flowdata, output_directory, fingerprint, outputFormat='csv'):
+    """
+    Updates the station's categories using the stored status bands, only the last output month and any newly appended days are aggregated and classified.
+    Returns the updated date, category dataframe, or None if the file needs fully recalculating because there are no stored bands
+    or they don't match the settings or the data.
+    """
+    fingerprintFile = f"{output_directory}statusBands/{stationID}_fingerprint.json"
+    if not os.path.exists(fingerprintFile) or not os.path.exists(categoriesPath(output_directory, stationID, outputFormat)):
+        print("No stored status bands, calculating from the full record.")
+        return None
+    with open(fingerprintFile, 'r') as fr:
+        stored = json.load(fr)
+    resumeDate = pd.Timestamp(stored['resumeDate'])
+    if any(stored.get(key) != fingerprint[key] for key in fingerprint) or flowdata['date'].max() < resumeDate \
+            or dataFingerprint(flowdata[flowdata['date'] < resumeDate]) != stored['history']:
+        print("Stored status bands don't match the settings or the data, calculating from the full record.")
+        return None
+
+    statusBands = pd.read_csv(f"{output_directory}statusBands/{stationID}_bands.csv", index_col=0, float_precision='round_trip')
+    groupBy = monthlyFlows(flowdata[flowdata['date'] >= resumeDate])
+    groupBy['percentile_flow'] = groupBy['mean_flow'] / np.array(stored['LTA'])[groupBy['month'].to_numpy() - 1] * 100
+    groupBy['category'] = assignCategories(groupBy['percentile_flow'].to_numpy(dtype=float), groupBy['month'].to_numpy(), statusBands.to_numpy())
+    groupBy['date'] = pd.to_datetime(groupBy[['year', 'month']].assign(DAY=1)).dt.strftime('%Y-%m-%d')
+
+    #swap the recalculated months into the previous output and filter to output length
+    previous = readCategories(output_directory, stationID, outputFormat)
+    output = pd.concat([previous[previous['date'] < stored['resumeDate']], groupBy.sort_values(['year','month']).filter(['date','category'])])
+    output['year'] = output['date'].str[:4].astype(int)
+    output = output[output['year'] >= (output['year'].max() - fingerprint['outputLength'])]
+    output['category'] = output['category'].astype('Int64')
+    output = output.filter(['date','category']).reset_index(drop=True)
+    writeCategories(output, output_directory, stationID, outputFormat)
+
+    fingerprint['LTA'] = stored['LTA']
+    writeFingerprint(stationID, flowdata, output_directory, fingerprint)
+    print(f"Updated {len(groupBy)} months from the stored status bands.")
+    return output
+
+def processStation(f, input_directory, output_directory, stdStart, stdEnd, dateFormat, outputLength, debugging=False, incremental=False, outputFormat='csv',
+                   cacheDirectory=None):
+    """
+    Calculates the status categories and status bands for one daily timeseries file (or parquet partition) and writes them to output_directory.
+    If incremental is set, the stored status bands are reused when they still match the reference period data.
+    outputFormat 'parquet' writes the categories to the output_directory/categories dataset instead of cat_{id}.csv.
+    cacheDirectory is passed to readFlowFile.
+    Returns the date, category, stationID dataframe and None, or None and the reason the file was skipped.
+    """
+    print(f)
+    stationID = stationName(f)
+    flowdata = readFlowData(f"{input_directory}{f}", dateFormat, cacheDirectory)
+
+    #check whether or not there is enough data? 
+    print(f"There are {flowdata['year'].max() - flowdata['year'].min()} years of data in this file.")
+    print(f"There are {sum(flowdata['flow'].isnull())} missing data points, which is {np.round(sum(flowdata['flow'].isnull())/len(flowdata) * 100,4)}% of the total data")
+
+    fingerprint = {'startYear': stdStart, 'endYear': stdEnd, 'outputLength': outputLength,
+                   'reference': dataFingerprint(flowdata[(flowdata['year'] >= stdStart) & (flowdata['year'] <= stdEnd)])}
+    if incremental:
+        categories = updateStation(stationID, flowdata, output_directory, fingerprint, outputFormat)
+        if categories is not None:
+            return categories.assign(stationID=stationID), None
+
+    """ STEP 1: CALCULATE MEAN MONTHLY FLOWS """
+
+    groupBy = monthlyFlows(flowdata)
+
+    """ STEP 2: CALCULATE MEAN MONTHLY FLOWS AS A PERCENTAGE OF AVERAGE REFERENCE PERIOD """
+
+    try:
+        LTA = percentageOfAverage(groupBy, stdStart, stdEnd)
+    except ValueError as e:
+        message = f"{e} for file {f}."
+        print(f"ERROR: {message} Skipping file")
+        return None, message
+
+    """ STEP 3: CALCULATE RANK PERCENTILES OF REFERENCE PERIOD """
+
+    statusBands = calculateStatusBands(groupBy, stdStart, stdEnd, debugging)
+
+    """ STEP 4: ASSIGN STATUS CATEGORIES """
+
+    groupBy['category'] = assignCategories(groupBy['percentile_flow'].to_numpy(dtype=float), groupBy['month'].to_numpy(), statusBands.to_numpy())
+
+    """ STEP 5: WRITE DATA """
+
+    categories = categoryOutput(groupBy, outputLength)
+    writeCategories(categories, output_directory, stationID, outputFormat)
+    statusBands.to_csv(f"{output_directory}/statusBands/{stationID}_bands.csv")
+    #record what the bands were calculated from, so later runs can update the categories incrementally
+    fingerprint['LTA'] = LTA.reindex(range(1,13)).tolist()
+    writeFingerprint(stationID, flowdata, output_directory, fingerprint)
+    return categories.assign(stationID=stationID), None
+
+def runStation(task):
+    """
+    Runs processStation for one (filename, ...) task, capturing what it prints so each station's log can be printed in order.
+    Returns the log along with processStation's categories and skip reason.
+    """
+    log = io.StringIO()
+    with redirect_stdout(log):
+        categories, skipped = processStation(*task)
+    return log.getvalue(), categories, skipped
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+                        prog='StatusCalc v3 PYTHON',
+                        description='Calculates status based on daily timeseries for the HydroSOS portal',
+                        epilog='Katie F-C, Ezra K, UKCEH, 14052024')
+
+
+    parser.add_argument('input_directory', help='input directory, should ONLY contain .csv daily timeseries, see GitHub for examples.')        
+    parser.add_argument('output_directory', help='directory files will be saved to as cat_{input_file}.csv')  
+    parser.add_argument('--inputFormat', help='csv (default) or parquet, parquet reads input_directory as a dataset partitioned by stationID with date and flow columns')
+    parser.add_argument('--outputFormat', help='csv (default) or parquet, parquet writes the categories as a dataset partitioned by stationID in output_directory/categories')
+    parser.add_argument('--dateFormat', help='format of the dates in the input directory (default %d/%m/%Y)')
+    parser.add_argument('--startYear', help='start of the year range that will be used to calculate the reference average.')
+    parser.add_argument('--endYear', help='end of the year range that will be used to calculate the reference average.')
+    parser.add_argument('--outputLength', help='how many years of data to output (default 5)')
+    parser.add_argument('--debugging', help='print debugging')
+    parser.add_argument('--incremental', help='set to 1 to reuse the stored statusBands and only recalculate the latest months, files are fully recalculated if the reference period data or years have changed')
+    parser.add_argument('--jsonDirectory', help='if set, the monthly {date}.json files for the portal are also written to this directory, as status_to_json.py would')
+    parser.add_argument('--workers', help='number of station files to process in parallel (default 1)')
+    parser.add_argument('--cacheDirectory', help='if set, parsed input csvs are cached in this directory and later runs only re-parse files that have changed')
+    parser.add_argument('--panel', help='set to 1 to load the stations into one date x station matrix and calculate them all at once, much faster for large networks, stations are read in blocks of 1000')
+
+    args = parser.parse_args()
+
+    if args.startYear:
+        stdStart=int(args.startYear)
+    else: 
+        print("No start year set, defaulting to 1991.")
+        stdStart=1991
+
+    if args.endYear:
+        stdEnd=int(args.endYear)
+    else: 
+        print("No end year set, defaulting to 2020.")
+        stdEnd=2020
+
+    if args.dateFormat:
+        dateFormat=args.dateFormat
+    else: 
+        print("No date format set, defaulting to %d/%m/%Y.")
+        dateFormat="%d/%m/%Y"
+
+    if args.outputLength:
+        outputLength = int(args.outputLength)
+    else:
+        print("No output length set, defaulting to 5 years.")
+        outputLength = 5
+
+    if args.workers:
+        workers = int(args.workers)
+    else:
+        workers = 1
+
+    inputFormat = args.inputFormat if args.inputFormat else 'csv'
+    outputFormat = args.outputFormat if args.outputFormat else 'csv'
+
+
+    assert stdStart < stdEnd, "startYear must be greater than endYear"
+
+    #stationid="39001"
+    #input_directory="./example_data/input/"
+    #output_directory="./example_data/output_Python/"
+
+    if not args.input_directory.endswith(os.sep):
+        args.input_directory = args.input_directory + os.sep
+
+    if not args.output_directory.endswith(os.sep):
+        args.output_directory = args.output_directory + os.sep
+
+    Path(args.output_directory).mkdir(parents=True, exist_ok=True)
+    Path(f"{args.output_directory}/statusBands").mkdir(parents=True, exist_ok=True)
+
+    if inputFormat == 'parquet':
+        inputFiles = [f for f in sorted(os.listdir(args.input_directory)) if f.startswith('stationID=')]
+    else:
+        inputFiles = [f for f in sorted(os.listdir(args.input_directory)) if f.endswith('.csv')]
+    tasks = [(f, args.input_directory, args.output_directory, stdStart, stdEnd, dateFormat, outputLength, args.debugging, args.incremental == "1", outputFormat, args.cacheDirectory)
+             for f in inputFiles]
+
+    skippedFiles = []
+    allCategories = []
+    if args.panel == "1":
+        #calculate blocks of stations at once as a date x station panel
+        if args.incremental == "1":
+            print("--incremental is not used with --panel, every file is recalculated.")
+        for start in range(0, len(inputFiles), PANEL_BLOCK):
+            blockFiles = inputFiles[start:start + PANEL_BLOCK]
+            print(f"Calculating status for {len(blockFiles)} files as a panel.")
+            categories, statusBands, skipped = calculateStatusPanel({f: readFlowFile(f"{args.input_directory}{f}", dateFormat, args.cacheDirectory) for f in blockFiles},
+                                                                    stdStart, stdEnd, outputLength, dateFormat)
+            for f, reason in skipped.items():
+                print(f"ERROR: {reason} for file {f}. Skipping file")
+                skippedFiles.append(f"{reason} for file {f}.")
+            categories['stationID'] = categories['stationID'].map(stationName)
+            for stationID, stationCategories in categories.groupby('stationID', sort=False):
+                writeCategories(stationCategories.filter(['date','category']).reset_index(drop=True), args.output_directory, stationID, outputFormat)
+            for f, bands in statusBands.items():
+                bands.to_csv(f"{args.output_directory}/statusBands/{stationName(f)}_bands.csv")
+                #the panel doesn't record what its bands came from, so an older fingerprint mustn't be trusted by --incremental
+                removeFingerprint(stationName(f), args.output_directory)
+            allCategories.append(categories)
+    elif workers > 1:
+        #stations are independent, so shard them over a process pool, results come back in file order
+        print(f"Processing {len(tasks)} files with {workers} workers.")
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for log, categories, skipped in executor.map(runStation, tasks, chunksize=max(1, len(tasks) // (workers * 4))):
+                print(log, end='')
+                if skipped:
+                    skippedFiles.append(skipped)
                 else:
-                    interpolated_percentile = lower_percentile + ((j - closest_lower) / (closest_higher - closest_lower)) * (higher_percentile - lower_percentile) 
-                if args.debugging: 
-                        print(f"Month : {i}")
-                        print(f"Percentiles in ref: {percentiles}")
-                        print(f"Ranks in ref: {ranks}")
-                        print(f"Target rank: {j}")
-                        print(f"Closest lower rank: {closest_lower}")
-                        print(f"Closest  higher rank: {closest_higher}")
-                        print(f"Closest lower index : {closest_lower_idx}")
-                        print(f"Closest lower percentile: {lower_percentile}")
-                        print(f"Closest higher percentile: {higher_percentile}")
-                        print(f"Interpolated percentile: {interpolated_percentile}")
-                #add this to the threshold dictionary
-                thresholdDict[i,j] = interpolated_percentile
-                #add min, mean and max to thresholdDict to 
-                thresholdDict[i,'max'] = np.nanmax(percentiles)
-                thresholdDict[i,'median'] = np.nanmedian(percentiles)
-                thresholdDict[i,'min'] = np.nanmin(percentiles)
-
-        """ STEP 4: ASSIGN STATUS CATEGORIES """
-
-        def flow_status(percentile, month, thresholdDict):
-            status = pd.NA
-            if percentile <= thresholdDict[month,0.1]:
-                status = 1
-            elif percentile <= thresholdDict[month,0.25]:
-                status = 2
-            elif percentile <= thresholdDict[month,0.75]:
-                status = 3
-            elif percentile <= thresholdDict[month,0.9]:
-                status = 4
-            elif percentile > thresholdDict[month,0.9]:
-                status = 5
-            return status
-
-        for i in groupBy.index:
-            groupBy.loc[i,'category'] = flow_status(percentile=groupBy.loc[i,'percentile_flow'],month=groupBy.loc[i,'month'],thresholdDict=thresholdDict)
-
-
-        """ STEP 5: WRITE DATA """
-        # filter to output length 
-        groupBy = groupBy[groupBy['year'] >= (max(groupBy['year']) - outputLength)]
-        groupBy['date'] = pd.to_datetime(groupBy[['year', 'month']].assign(DAY=1))
-        groupBy['date'] = groupBy['date'].dt.strftime('%Y-%m-%d')
-        groupBy['category'] = groupBy['category'].astype('Int64')
-        groupBy.sort_values(['year','month']).filter(['date','category']).to_csv(f"{args.output_directory}cat_{f}", index=False)
-        forecastBands = pd.DataFrame.from_dict(pd.Series(thresholdDict).unstack())
-        forecastBands.to_csv(f"{args.output_directory}/statusBands/{f.split('.')[0]}_bands.csv")
-       
-
-
-
-
-        
+                    allCategories.append(categories)
+    else:
+        for task in tasks:
+            categories, skipped = processStation(*task)
+            if skipped:
+                skippedFiles.append(skipped)
+            else:
+                allCategories.append(categories)
+
+    #write the monthly json for the portal straight from memory rather than re-reading the cat_ files
+    if args.jsonDirectory and allCategories:
+        print(f"Writing monthly json files to {args.jsonDirectory}")
+        writeStatusJson(pd.concat(allCategories, ignore_index=True), args.jsonDirectory)
+
+    print(f"Processed {len(tasks) - len(skippedFiles)} of {len(tasks)} files.")
+    if skippedFiles:
+        print(f"Skipped {len(skippedFiles)} files:")
+        for skipped in skippedFiles:
+            print(f"  {skipped}")
@@ -0,0 +1,301 @@
+"""
+Synthetic data benchmark for the status and forecast scripts.
+
+Generates synthetic daily status timeseries, ensemble forecasts, combined ESP files and OUTLAST netcdf files, then times
+statuscalc.py, status_to_json.py, forecastcalc.py, reformatESP.py, forecast_to_json.py, hydrosos_forecast_status_to_json.py,
+forecast_to_geotiff.py and outlastnc_proc.py on them. Each script runs in its own process so the peak memory reported is that
+script's alone. It also checks the scripts still reproduce the outputs in example_data.
+
+Usage
+
+python tests/benchmark.py --stations 200 --years 40 --gapRate 0.02 --members 51 --leadMonths 6
+
+The GeoTIFF stages need geopandas, geocube and rasterio, outlastnc_proc.py also needs netCDF4, and are skipped if they are not installed.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+repo_directory = Path(__file__).resolve().parent.parent
+example_directory = repo_directory / 'example_data'
+
+
+##############################################
+# Synthetic data
+##############################################
+
+#seasonal daily flows with lognormal noise, with runs of missing days removed at roughly gapRate
+def makeDailyFlows(rng, dates, gapRate):
+    dayOfYear = dates.dayofyear.to_numpy()
+    seasonal = 1 + 0.6 * np.sin(2 * np.pi * (dayOfYear / 365.25 + rng.random()))
+    flows = np.round(rng.lognormal(2, 1) * seasonal * rng.lognormal(0, 0.4, len(dates)), 3)
+    keep = np.ones(len(dates), dtype=bool)
+    meanGapLength = 10
+    for start in rng.integers(0, len(dates), int(gapRate * len(dates) / meanGapLength)):
+        keep[start:start + rng.geometric(1 / meanGapLength)] = False
+    return dates[keep], flows[keep]
+
+#daily status input files as statuscalc.py reads them, returns the number of rows written
+def makeStatusInput(directory, stations, years, gapRate, rng, endYear):
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    allDates = pd.date_range(f"{endYear - years + 1}-01-01", f"{endYear}-12-31")
+    rows = 0
+    for station in range(1, stations + 1):
+        dates, flows = makeDailyFlows(rng, allDates, gapRate)
+        pd.DataFrame({'date': dates.strftime('%d/%m/%Y'), 'flow': flows}).to_csv(f"{directory}/{station}.csv", index=False)
+        rows += len(dates)
+    return rows
+
+#obssim and ensemble forecast files as forecastcalc.py reads them, returns the number of rows written
+def makeForecastInput(obs_directory, forecast_directory, catchments, years, members, leadMonths, rng, forecastStart):
+    Path(obs_directory).mkdir(parents=True, exist_ok=True)
+    Path(forecast_directory).mkdir(parents=True, exist_ok=True)
+    obsDates = pd.date_range(f"{forecastStart.year - years}-01-01", f"{forecastStart.year - 1}-12-31")
+    forecastDates = pd.date_range(forecastStart, periods=leadMonths + 1, freq='MS').strftime('%Y-%m')
+    rows = 0
+    for catchment in range(1, catchments + 1):
+        dates, flows = makeDailyFlows(rng, obsDates, 0)
+        pd.DataFrame({'Date': dates.strftime('%Y-%m-%d'), 'Discharge': flows}).to_csv(f"{obs_directory}/obs_{catchment}.csv", index=False)
+        level = flows.mean()
+        for member in range(1, members + 1):
+            forecast = np.round(level * rng.lognormal(0, 0.5, len(forecastDates)), 6)
+            pd.DataFrame({'Date': forecastDates, 'Discharge': forecast}).to_csv(f"{forecast_directory}/forecast_ENS{member}_{catchment}.csv", index=False)
+        rows += len(dates) + members * len(forecastDates)
+    return rows
+
+#combined daily ESP files as reformatESP.py and forecastcalc.py --inputFormat esp read them, the obssim rows followed by the
+#forecast rows of every member, returns the number of rows written
+def makeESPInput(directory, catchments, years, members, leadMonths, rng, forecastStart):
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    obsDates = pd.date_range(f"{forecastStart.year - years}-01-01", forecastStart - pd.Timedelta(days=1))
+    forecastDates = pd.date_range(forecastStart, forecastStart + pd.DateOffset(months=leadMonths + 1) - pd.Timedelta(days=1))
+    rows = 0
+    for catchment in range(1, catchments + 1):
+        _, flows = makeDailyFlows(rng, obsDates, 0)
+        data = pd.DataFrame({'DATE': obsDates.append(forecastDates).strftime('%Y-%m-%d'),
+                             'obsSim': np.concatenate([flows, np.full(len(forecastDates), np.nan)])})
+        forecast = np.full((len(data.index), members), np.nan)
+        forecast[len(obsDates):] = np.round(flows.mean() * rng.lognormal(0, 0.5, (len(forecastDates), members)), 3)
+        data = pd.concat([data, pd.DataFrame(forecast, columns=[f"ENS{member}" for member in range(1, members + 1)])], axis=1)
+        data.to_csv(f"{directory}/{catchment}_ESP_{forecastStart.year}{forecastStart.month}_combined.csv", index=False)
+        rows += len(data.index)
+    return rows
+
+#a grid of 1 degree square basins with HYBAS_ID set to the catchment number
+def makeBasins(path, catchments):
+    import geopandas as gpd
+    from shapely.geometry import box
+    columns = int(np.ceil(np.sqrt(catchments)))
+    geometry = [box(-60 + (i % columns), -30 + (i // columns), -59 + (i % columns), -29 + (i // columns)) for i in range(catchments)]
+    gpd.GeoDataFrame({'HYBAS_ID': np.arange(1, catchments + 1)}, geometry=geometry, crs='EPSG:4326').to_file(path)
+
+#status and forecast netcdf files as outlastnc_proc.py reads them, monthly OUTLAST (11) and HydroSOS (5) classes for every basin,
+#and for the forecast the member count of each class and the majority class. Returns the number of basin months written
+def makeOutlastInput(status_path, forecast_path, catchments, statusMonths, leadMonths, members, rng, forecastStart):
+    import netCDF4 as nc
+    rows = 0
+    for path, months, start, forecast in [(status_path, statusMonths, forecastStart - pd.DateOffset(months=statusMonths), False),
+                                          (forecast_path, leadMonths, forecastStart, True)]:
+        with nc.Dataset(path, 'w') as data:
+            data.createDimension('time', months)
+            data.createDimension('basin', catchments)
+            time = data.createVariable('time', 'f8', ('time',))
+            time.units = f"days since {start.strftime('%Y-%m-%d')}"
+            time[:] = (pd.date_range(start, periods=months, freq='MS') - start).days.to_numpy()
+            data.createVariable('basin_id', 'i8', ('basin',))[:] = np.arange(1, catchments + 1)
+            for name, classes in [('OUTLAST', 11), ('HydroSOS', 5)]:
+                if forecast:
+                    counts = rng.multinomial(members, np.full(classes, 1 / classes), (months, catchments))
+                    for i in range(classes):
+                        data.createVariable(f"spi_{name}_cat{i}", 'i4', ('time', 'basin'))[:] = counts[..., i]
+                    data.createVariable(f"spi_{name}_maj", 'i4', ('time', 'basin'))[:] = counts.argmax(axis=2)
+                else:
+                    data.createVariable(f"spi_{name}", 'i4', ('time', 'basin'))[:] = rng.integers(0, classes, (months, catchments))
+        rows += months * catchments
+    return rows
+
+
+##############################################
+# Timing
+##############################################
+
+#run a script in its own process, returning the wall time and its peak memory in MB
+def runStage(script, arguments):
+    with tempfile.TemporaryFile() as log:
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, str(repo_directory / script)] + [str(a) for a in arguments], stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.perf_counter() - start
+        if os.waitstatus_to_exitcode(status) != 0:
+            log.seek(0)
+            raise RuntimeError(f"{script} failed:\n{log.read().decode()[-2000:]}")
+    #ru_maxrss is in KB on linux
+    return elapsed, usage.ru_maxrss / 1024
+
+def countRows(directory):
+    return sum(len(pd.read_csv(f"{directory}/{f}")) for f in os.listdir(directory) if f.endswith('.csv'))
+
+
+##############################################
+# Parity with example_data
+##############################################
+
+#statuscalc must reproduce the example bands exactly, and the example categories wherever the dates overlap
+def checkStatusParity(work_directory, options=()):
+    output = f"{work_directory}/parity_status{''.join(str(o) for o in options)}/"
+    runStage('status/statuscalc.py', [example_directory / 'status/input/', output, '--startYear', 1990, '--endYear', 2020, '--outputLength', 40] + list(options))
+    expected_directory = example_directory / 'status/output/output_Python'
+    for f in os.listdir(expected_directory / 'statusBands'):
+        expected = pd.read_csv(expected_directory / 'statusBands' / f, index_col=0, float_precision='round_trip')
+        actual = pd.read_csv(f"{output}statusBands/{f}", index_col=0, float_precision='round_trip')
+        assert expected.equals(actual), f"statusBands/{f} differs from example_data"
+    for f in os.listdir(expected_directory):
+        if f.endswith('.csv'):
+            merged = pd.read_csv(expected_directory / f).merge(pd.read_csv(f"{output}{f}"), on='date', suffixes=('_expected', ''))
+            assert len(merged) > 0 and (merged['category_expected'] == merged['category']).all(), f"{f} differs from example_data"
+
+#forecastcalc must reproduce the example counts, bands, percentiles and forecasts (members may be in any column order)
+def checkForecastParity(work_directory):
+    output = f"{work_directory}/parity_forecast"
+    runStage('forecast/forecastcalc.py', [example_directory / 'forecast/input/obs_dir', example_directory / 'forecast/input/forecast_dir', output])
+    expected_directory = example_directory / 'forecast/output'
+    for subdirectory in ['accumulated/counts', 'accumulated/forecastBands', 'accumulated/percentiles', 'accumulated/forecasts',
+                         'single/counts', 'single/forecastBands', 'single/percentiles', 'single/forecasts']:
+        for f in os.listdir(expected_directory / subdirectory):
+            expected = pd.read_csv(expected_directory / subdirectory / f, dtype=str)
+            actual = pd.read_csv(f"{output}/{subdirectory}/{f}", dtype=str)
+            assert expected.equals(actual[expected.columns]), f"{subdirectory}/{f} differs from example_data"
+
+#hydrosos_forecast_status_to_json must still write every month's json as an empty list when its input directories have no csvs
+def checkStatusJsonEmptyParity(work_directory):
+    input_directory = f"{work_directory}/parity_status_json_empty"
+    output = f"{work_directory}/parity_status_json_empty_output"
+    for subdirectory in ['status/status', 'status/statusBands']:
+        Path(f"{input_directory}/{subdirectory}").mkdir(parents=True, exist_ok=True)
+    runStage('other/hydrosos_forecast_status_to_json.py', ['2024-02', input_directory, output])
+    for subdirectory, months in [('status/status', 6), ('status/statusBands', 12)]:
+        files = os.listdir(f"{output}/{subdirectory}")
+        assert len(files) == months, f"{subdirectory} has {len(files)} json files, expected {months}"
+        for f in files:
+            with open(f"{output}/{subdirectory}/{f}") as fr:
+                assert json.load(fr) == [], f"{subdirectory}/{f} isn't an empty list"
+
+
+##############################################
+# Main
+##############################################
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+                        prog='HydroSOS benchmark',
+                        description='Times the status and forecast scripts on synthetic data and checks parity with example_data.')
+
+    parser.add_argument('--stations', type=int, default=50, help='number of synthetic stations/catchments (default 50)')
+    parser.add_argument('--years', type=int, default=35, help='years of daily data per station (default 35)')
+    parser.add_argument('--gapRate', type=float, default=0.02, help='fraction of status days removed as gaps (default 0.02)')
+    parser.add_argument('--members', type=int, default=51, help='ensemble members per catchment (default 51)')
+    parser.add_argument('--leadMonths', type=int, default=6, help='forecast lead months (default 6)')
+    parser.add_argument('--workers', type=int, default=1, help='passed to statuscalc.py and forecastcalc.py --workers (default 1)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the synthetic data (default 0)')
+    parser.add_argument('--workDirectory', help='directory for the synthetic data and outputs (default a temporary directory)')
+    parser.add_argument('--skipParity', action='store_true', help='skip the example_data parity checks')
+    parser.add_argument('--skipGeotiff', action='store_true', help='skip the GeoTIFF export stages')
+
+    args = parser.parse_args()
+
+    work_directory = args.workDirectory if args.workDirectory else tempfile.mkdtemp(prefix='hydrosos_benchmark_')
+    rng = np.random.default_rng(args.seed)
+    forecastStart = pd.Timestamp('2024-02-01')
+    print(f"Writing synthetic data to {work_directory}")
+
+    statusRows = makeStatusInput(f"{work_directory}/status_input", args.stations, args.years, args.gapRate, rng, forecastStart.year - 1)
+    forecastRows = makeForecastInput(f"{work_directory}/obs_dir", f"{work_directory}/forecast_dir", args.stations, args.years,
+                                     args.members, args.leadMonths, rng, forecastStart)
+
+    results = []
+    elapsed, memory = runStage('status/statuscalc.py', [f"{work_directory}/status_input/", f"{work_directory}/status_output/",
+                                                       '--startYear', forecastStart.year - args.years, '--endYear', forecastStart.year - 1,
+                                                       '--workers', args.workers])
+    results.append(('statuscalc', statusRows, elapsed, memory))
+
+    elapsed, memory = runStage('status/statuscalc.py', [f"{work_directory}/status_input/", f"{work_directory}/status_panel_output/",
+                                                       '--startYear', forecastStart.year - args.years, '--endYear', forecastStart.year - 1,
+                                                       '--panel', 1])
+    results.append(('statuscalc --panel', statusRows, elapsed, memory))
+
+    jsonRows = countRows(f"{work_directory}/status_output")
+    elapsed, memory = runStage('status/status_to_json.py', [f"{work_directory}/status_output", f"{work_directory}/status_json"])
+    results.append(('status_to_json', jsonRows, elapsed, memory))
+
+    elapsed, memory = runStage('forecast/forecastcalc.py', [f"{work_directory}/obs_dir", f"{work_directory}/forecast_dir", f"{work_directory}/forecast_output",
+                                                           '--workers', args.workers])
+    results.append(('forecastcalc', forecastRows, elapsed, memory))
+
+    espRows = makeESPInput(f"{work_directory}/esp_input", args.stations, args.years, args.members, args.leadMonths, rng, forecastStart)
+    elapsed, memory = runStage('other/reformatESP.py', [forecastStart.strftime('%Y-%m'), f"{work_directory}/esp_input", f"{work_directory}/esp_reformatted"])
+    results.append(('reformatESP', espRows, elapsed, memory))
+    elapsed, memory = runStage('forecast/forecastcalc.py', [f"{work_directory}/esp_reformatted/obsDir", f"{work_directory}/esp_reformatted/forecastDir",
+                                                           f"{work_directory}/esp_output_reformatted", '--workers', args.workers])
+    results.append(('forecastcalc reformat', espRows, elapsed, memory))
+    elapsed, memory = runStage('forecast/forecastcalc.py', [f"{work_directory}/esp_input", f"{work_directory}/esp_input", f"{work_directory}/esp_output",
+                                                           '--inputFormat', 'esp', '--forecastDate', forecastStart.strftime('%Y-%m'), '--workers', args.workers])
+    results.append(('forecastcalc esp', espRows, elapsed, memory))
+
+    countsRows = countRows(f"{work_directory}/forecast_output/single/counts")
+    elapsed, memory = runStage('forecast/forecast_to_json.py', [f"{work_directory}/forecast_output/single/counts", f"{work_directory}/forecast_output/single"])
+    results.append(('forecast_to_json', countsRows, elapsed, memory))
+
+    #the status and statusBands forecastcalc wrote for the portal json
+    statusJsonRows = countRows(f"{work_directory}/forecast_output/status/status") + countRows(f"{work_directory}/forecast_output/status/statusBands")
+    elapsed, memory = runStage('other/hydrosos_forecast_status_to_json.py', [forecastStart.strftime('%Y-%m'), f"{work_directory}/forecast_output",
+                                                                             f"{work_directory}/status_json_hydrosos"])
+    results.append(('hydrosos_status_to_json', statusJsonRows, elapsed, memory))
+
+    if not args.skipGeotiff:
+        try:
+            makeBasins(f"{work_directory}/basins.shp", args.stations)
+        except ImportError as e:
+            print(f"Skipping GeoTIFF export, {e}")
+        else:
+            elapsed, memory = runStage('forecast/forecast_to_geotiff.py', [f"{work_directory}/forecast_output/single/", f"{work_directory}/geotiff/",
+                                                                         f"{work_directory}/basins.shp", forecastStart.strftime('%Y-%m'),
+                                                                         '--forecast_length', args.leadMonths])
+            results.append(('forecast_to_geotiff', countsRows, elapsed, memory))
+
+            try:
+                outlastRows = makeOutlastInput(f"{work_directory}/outlast_status.nc", f"{work_directory}/outlast_forecast.nc", args.stations,
+                                               12, args.leadMonths, args.members, rng, forecastStart)
+            except ImportError as e:
+                print(f"Skipping outlastnc_proc, {e}")
+            else:
+                elapsed, memory = runStage('other/outlastnc_proc.py', [f"{work_directory}/outlast_status.nc", f"{work_directory}/outlast_forecast.nc",
+                                                                       f"{work_directory}/basins.shp", f"{work_directory}/outlast_output",
+                                                                       forecastStart.strftime('%Y-%m')])
+                results.append(('outlastnc_proc', outlastRows, elapsed, memory))
+
+    print()
+    print(f"{args.stations} stations, {args.years} years, gap rate {args.gapRate}, {args.members} members, {args.leadMonths} lead months")
+    print(f"{'stage':<26}{'rows':>12}{'seconds':>10}{'rows/sec':>14}{'peak MB':>10}")
+    for stage, rows, elapsed, memory in results:
+        print(f"{stage:<26}{rows:>12}{elapsed:>10.2f}{rows / elapsed:>14.0f}{memory:>10.0f}")
+
+    if not args.skipParity:
+        print()
+        checkStatusParity(work_directory)
+        print("statuscalc matches example_data.")
+        checkStatusParity(work_directory, ['--panel', 1])
+        print("statuscalc --panel matches example_data.")
+        checkForecastParity(work_directory)
+        print("forecastcalc matches example_data.")
+        checkStatusJsonEmptyParity(work_directory)
+        print("hydrosos_forecast_status_to_json writes empty lists for empty inputs.")
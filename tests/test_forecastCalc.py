@@ -0,0 +1,91 @@
+import os, subprocess, sys
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'forecast'))
+import forecastcalc
+
+prob = [.05, .1, .25, .5, .75, .9, .95]
+#rows of 8 values with 8, 6, 1 and 0 non-na values
+values = np.array([[3., 1., 4., 1., 5., 9., 2., 6.],
+                   [2.7, np.nan, 1.8, 2.8, np.nan, 1.8, 4.5, 9.0],
+                   [np.nan, np.nan, np.nan, 7.5, np.nan, np.nan, np.nan, np.nan],
+                   [np.nan]*8])
+
+
+def test_cunnaneQuantiles_matches_masked_mquantiles():
+    #scipy.stats.mstats.mquantiles(np.ma.masked_invalid(row), prob, alphap=.4, betap=.4) for each row
+    expected = np.array([[1.0, 1.0, 1.4500000000000002, 3.5, 5.55, 8.34, 9.0],
+                         [1.8, 1.8, 1.8, 2.75, 4.724999999999999, 8.910000000000002, 9.0],
+                         [7.5]*7,
+                         [np.nan]*7])
+    assert np.allclose(forecastcalc.cunnaneQuantiles(values, prob), expected, rtol=0, atol=1e-12, equal_nan=True)
+
+
+def test_cunnaneQuantiles_with_row_length_matches_unmasked_mquantiles():
+    #scipy.stats.mstats.mquantiles(row, prob, alphap=.4, betap=.4), the na values are sorted last and counted
+    expected = np.array([[1.0, 1.0, 1.4500000000000002, 3.5, 5.55, 8.34, 9.0],
+                         [1.8, 1.8, 2.205, 3.65, np.nan, np.nan, np.nan],
+                         [np.nan]*7,
+                         [np.nan]*7])
+    assert np.allclose(forecastcalc.cunnaneQuantiles(values, prob, n=values.shape[-1]), expected, rtol=0, atol=1e-12, equal_nan=True)
+
+
+def test_cunnaneQuantiles_single_and_empty_rows():
+    #mquantiles([7.5], prob) is 7.5 for every prob, no values gives na
+    single = np.array([[7.5], [np.nan]])
+    for n in (None, 1):
+        assert np.array_equal(forecastcalc.cunnaneQuantiles(single, prob, n), np.array([[7.5]*7, [np.nan]*7]), equal_nan=True)
+    for n in (None, 0):
+        assert np.isnan(forecastcalc.cunnaneQuantiles(np.empty((2, 0)), prob, n)).all()
+
+
+def settings(forecast_directory, status_directory, inputFormat='csv'):
+    return forecastcalc.Settings(str(forecast_directory), str(status_directory), None, inputFormat, 'csv', 'Discharge', None, None, None)
+
+
+def test_buildCatchmentIndex_prefixes_ENS_and_matches_obssim_by_second_field(tmp_path):
+    forecastDir, obsDir = tmp_path / 'forecast', tmp_path / 'obs'
+    forecastDir.mkdir(); obsDir.mkdir()
+    for f in ['forecast_A_1.csv', 'forecast_ENS2_1.csv', 'forecast_B_22.csv', 'notes.txt']:
+        (forecastDir / f).write_text('')
+    for f in ['obs_1.csv', 'sim_22_daily.csv', 'obs_2.csv', 'obs_12.csv', 'obs.csv']:
+        (obsDir / f).write_text('')
+    catchmentIndex = forecastcalc.buildCatchmentIndex(settings(forecastDir, obsDir))
+    assert catchmentIndex == {'1': {'forecasts': [('ENSA', 'forecast_A_1.csv'), ('ENS2', 'forecast_ENS2_1.csv')], 'status': ['obs_1.csv']},
+                              '22': {'forecasts': [('ENSB', 'forecast_B_22.csv')], 'status': ['sim_22_daily.csv']}}
+
+
+def test_getForecastCounts_bins_members_and_leaves_na_edges_empty():
+    #one catchment, two lead months, five members, the last member missing
+    values = np.array([[[0.5, 1., 2.5, 10., np.nan], [0.5, 1., 2.5, 10., np.nan]]])
+    cube = forecastcalc.EnsembleCube(['1'], None, ['ENS1', 'ENS2', 'ENS3', 'ENS4', 'ENS5'], values, ~np.isnan(values[:, 0]))
+    edges = np.array([[[1., 2., 3., 4.], [1., np.nan, 3., 4.]]])
+    counts = forecastcalc.getForecastCounts(cube, edges)
+    assert np.array_equal(counts, np.array([[[1., 1., 1., 0., 1.], [np.nan]*5]]), equal_nan=True)
+    table = forecastcalc.countsTable(pd.date_range('2024-02-01', periods=2, freq='MS'), counts[0])
+    counts = table[forecastcalc.COUNT_COLUMNS]
+    assert (counts.dtypes == 'Int64').all() and counts.iloc[1].isna().all() and counts.iloc[0].tolist() == [1, 1, 1, 0, 1]
+
+
+def test_hindcast_matches_separate_runs(tmp_path):
+    example = os.path.join(os.path.dirname(__file__), '..', 'example_data', 'forecast', 'input')
+    script = os.path.join(os.path.dirname(__file__), '..', 'forecast', 'forecastcalc.py')
+    #two forecast start dates, the example forecasts and the same values from 2023-09 without catchment 3
+    for start, months in (('2023-09', -5), ('2024-02', 0)):
+        (tmp_path / 'fc' / start).mkdir(parents=True)
+        for f in sorted(os.listdir(f"{example}/forecast_dir")):
+            if start == '2023-09' and f.endswith('_3.csv'):
+                continue
+            forecast = pd.read_csv(f"{example}/forecast_dir/{f}")
+            forecast['Date'] = (pd.to_datetime(forecast['Date']) + pd.DateOffset(months=months)).dt.strftime('%Y-%m')
+            forecast.to_csv(tmp_path / 'fc' / start / f, index=False)
+    subprocess.run([sys.executable, script, f"{example}/obs_dir", str(tmp_path / 'fc'), f"{tmp_path}/hindcast/", '--hindcast', '1'], check=True, capture_output=True)
+    for start in ('2023-09', '2024-02'):
+        subprocess.run([sys.executable, script, f"{example}/obs_dir", str(tmp_path / 'fc' / start), f"{tmp_path}/{start}/"], check=True, capture_output=True)
+        files = sorted(os.path.relpath(os.path.join(d, f), tmp_path / start) for d, _, fs in os.walk(tmp_path / start) for f in fs)
+        assert len(files) > 0
+        for f in files:
+            #the status outputs of every start date's catchments are written once, outside the start date subdirectories
+            hindcast = tmp_path / 'hindcast' / (f if f.startswith('status') else f"{start}/{f}")
+            assert hindcast.read_bytes() == (tmp_path / start / f).read_bytes(), f
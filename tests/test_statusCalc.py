@@ -0,0 +1,108 @@
+import os, subprocess, sys
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'status'))
+import statuscalc
+
+example_directory = os.path.join(os.path.dirname(__file__), '..', 'example_data', 'status')
+stations = ("12001","33035","39001","44008")
+
+
+def readStation(station):
+    return pd.read_csv(f"{example_directory}/input/{station}.csv")
+
+
+def test_calculateStatus_matches_example_outputs():
+    for station in stations:
+        categories, statusBands = statuscalc.calculateStatus(readStation(station), 1990, 2020, outputLength=20, dateFormat="%d/%m/%Y")
+        expectedBands = pd.read_csv(f"{example_directory}/output/output_Python/statusBands/{station}_bands.csv", index_col=0, float_precision='round_trip')
+        assert np.array_equal(statusBands.to_numpy(), expectedBands.to_numpy(), equal_nan=True)
+        expected = pd.read_csv(f"{example_directory}/output/output_Python/cat_{station}.csv")
+        merged = expected.merge(categories, on='date', suffixes=('_expected', ''))
+        assert len(merged) == len(expected)
+        assert (merged['category_expected'] == merged['category']).all()
+
+
+def test_calculateThresholds_stack_matches_single_stations():
+    rng = np.random.default_rng(0)
+    stack = rng.gamma(2, 50, size=(5, 12, 30)).round(1)
+    stack[rng.random(stack.shape) < 0.1] = np.nan
+    batched = statuscalc.calculateThresholds(stack)
+    assert batched.shape == (5, 12, len(statuscalc.BAND_COLUMNS))
+    for station in range(5):
+        assert np.array_equal(batched[station], statuscalc.calculateThresholds(stack[station]), equal_nan=True)
+
+
+def test_assignCategories_boundaries():
+    thresholds = np.tile([10., 25., 75., 90., 100., 50., 0.], (12, 1))
+    thresholds[5, :] = np.nan
+    percentiles = np.array([5., 10., 10.5, 25., 75., 90., 95., np.nan, 50.])
+    months = np.array([1, 1, 1, 2, 3, 4, 5, 7, 6])
+    categories = statuscalc.assignCategories(percentiles, months, thresholds)
+    assert np.array_equal(categories, [1, 1, 2, 2, 3, 4, 5, np.nan, np.nan], equal_nan=True)
+
+
+def test_calculateStatusBatch_reports_skipped_stations():
+    short = readStation("12001").tail(300)
+    categories, statusBands, skipped = statuscalc.calculateStatusBatch({"12001": readStation("12001"), "short": short}, 1990, 2020, dateFormat="%d/%m/%Y")
+    assert list(statusBands) == ["12001"]
+    assert "Long Term Average" in skipped["short"]
+    assert list(categories.columns) == ['date', 'category', 'stationID']
+    assert (categories['stationID'] == "12001").all()
+
+
+def test_calculateStatusPanel_matches_batch():
+    panelStations = {station: readStation(station) for station in stations}
+    panelStations["gappy"] = readStation("39001").sample(frac=0.6, random_state=0).sort_index()
+    panelStations["short"] = readStation("12001").tail(300)
+    expected = statuscalc.calculateStatusBatch(panelStations, 1990, 2020, outputLength=10, dateFormat="%d/%m/%Y")
+    categories, statusBands, skipped = statuscalc.calculateStatusPanel(panelStations, 1990, 2020, outputLength=10, dateFormat="%d/%m/%Y")
+    assert skipped == expected[2]
+    assert list(statusBands) == list(expected[1])
+    for station in statusBands:
+        assert statusBands[station].equals(expected[1][station])
+    order = ['stationID', 'date']
+    assert categories.sort_values(order).reset_index(drop=True).equals(expected[0].sort_values(order).reset_index(drop=True))
+
+
+def test_readFlowFile_cache_serves_unchanged_and_appended_files(tmp_path):
+    lines = open(f"{example_directory}/input/12001.csv").read().splitlines(True)
+    path = str(tmp_path / "12001.csv")
+    open(path, 'w').writelines(lines[:-100])
+    cache = str(tmp_path / "cache")
+    first = statuscalc.readFlowFile(path, "%d/%m/%Y", cache)
+    assert first.equals(statuscalc.readFlowFile(path, "%d/%m/%Y", cache))
+    open(path, 'a').writelines(lines[-100:])
+    expected = statuscalc.parseFlowCsv(path, "%d/%m/%Y")
+    assert statuscalc.readFlowFile(path, "%d/%m/%Y", cache).equals(expected)
+    assert statuscalc.prepareFlowData(statuscalc.readFlowFile(path, "%d/%m/%Y", cache)).equals(statuscalc.readFlowData(path, "%d/%m/%Y"))
+
+
+def test_prepareFlowData_fills_gaps_and_monthlyFlows_completeness():
+    flowdata = pd.DataFrame({'date': ["01/01/2000", "02/01/2000", "20/01/2000", "01/02/2000", "29/02/2000"], 'flow': [1, 2, 3, 4, 5]})
+    prepared = statuscalc.prepareFlowData(flowdata, "%d/%m/%Y")
+    assert len(prepared) == 60
+    assert prepared['date'].is_unique
+    assert prepared['flow'].isnull().sum() == 55
+    groupBy = statuscalc.monthlyFlows(prepared)
+    assert np.allclose(groupBy['monthly%'], [3 / 31 * 100, 2 / 29 * 100])
+    assert groupBy['mean_flow'].isnull().all()
+
+
+def test_incremental_after_panel_recalculates(tmp_path):
+    input_directory = tmp_path / "input"
+    input_directory.mkdir()
+    for station in ("12001", "39001"):
+        readStation(station).to_csv(input_directory / f"{station}.csv", index=False)
+    script = os.path.join(os.path.dirname(__file__), '..', 'status', 'statuscalc.py')
+    def run(output, *options):
+        subprocess.run([sys.executable, script, f"{input_directory}/", f"{output}/", '--outputLength', '10'] + [str(o) for o in options],
+                       check=True, capture_output=True)
+    run(tmp_path / "updated", '--startYear', 1990, '--endYear', 2020)
+    run(tmp_path / "updated", '--startYear', 1995, '--endYear', 2015, '--panel', 1)
+    run(tmp_path / "updated", '--startYear', 1990, '--endYear', 2020, '--incremental', 1)
+    run(tmp_path / "fresh", '--startYear', 1990, '--endYear', 2020)
+    for station in ("12001", "39001"):
+        for f in (f"cat_{station}.csv", f"statusBands/{station}_bands.csv"):
+            assert (tmp_path / "updated" / f).read_bytes() == (tmp_path / "fresh" / f).read_bytes(), f
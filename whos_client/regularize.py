@@ -2,14 +2,19 @@ import pandas
 import argparse
 import os
 
-def regularizeDir(input_dir : str, output_dir : str):
+def regularizeDir(input_dir : str, output_dir : str, output_format : str = "csv"):
     if input_dir == output_dir:
         raise ValueError("input_dir and output_dir must be different")
     for f in os.listdir(input_dir):
         if f.endswith('.csv'):
-            regularize(os.path.join(input_dir, f), os.path.join(output_dir,f))
+            if output_format == "parquet":
+                # one partition per station of a parquet dataset keyed by stationID
+                output = os.path.join(output_dir, "stationID=%s" % os.path.splitext(f)[0], "part-0.parquet")
+            else:
+                output = os.path.join(output_dir,f)
+            regularize(os.path.join(input_dir, f), output, output_format)
 
-def regularize(input : str, output : str):
+def regularize(input : str, output : str, output_format : str = "csv"):
     # read om-api-client data .csv (cols: date (iso format),value (float))
     try:
         flowdata = pandas.read_csv(input)
@@ -23,6 +28,13 @@ def regularize(input : str, output : str):
     # regularize to daily step, average rows of same date, remove nulls
     flowdata = flowdata.resample('D').mean().dropna()
     flowdata.reset_index(inplace=True)
+    if output_format == "parquet":
+        # dates are kept as (naive, like the csv output) datetimes, so statuscalc doesn't need to parse them
+        if flowdata['date'].dt.tz is not None:
+            flowdata['date'] = flowdata['date'].dt.tz_localize(None)
+        os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+        flowdata.to_parquet(output, index=False)
+        return
     # output date format "%d/%m/%Y"
     flowdata['date'] = flowdata['date'].dt.strftime('%d/%m/%Y')
     flowdata.to_csv(open(output, "w"), index=False)
@@ -36,12 +48,13 @@ if __name__ == "__main__":
 
     parser.add_argument('input', help='input csv file with dates in ISO format. If a directory is passed, reads all .csv files in that directory.')
     parser.add_argument('output', help='output file or directory')
+    parser.add_argument('--output_format', choices=['csv', 'parquet'], default='csv', help='csv (default) or parquet. For a directory input, parquet writes a dataset partitioned by stationID that statuscalc.py can read with --inputFormat parquet')
 
     args = parser.parse_args()
 
     if os.path.isdir(args.input):
         if not os.path.isdir(args.output):
             raise ValueError("If input is a directory, output must also be a directory")
-        regularizeDir(args.input, args.output)
+        regularizeDir(args.input, args.output, args.output_format)
     else:
-        regularize(args.input, args.output)
\ No newline at end of file
+        regularize(args.input, args.output, args.output_format)
\ No newline at end of file